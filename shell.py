@@ -1,202 +1,3404 @@
+import time
+_STARTUP_T0 = time.perf_counter()  # reported by --startup-benchmark
+
 import os
+import sys
+import argparse
+import asyncio
 import threading
 import subprocess
-import time
+import shutil
+import shlex
+import tempfile
+import signal
+import select
 import json
 import glob
 import re
+import sqlite3
+import queue
+import bisect
+import heapq
+import itertools
+import random
+from email.utils import parsedate_to_datetime
+from collections import OrderedDict, deque
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from typing import Dict, List, Optional
-from openai import OpenAI, APIConnectionError
+from typing import Dict, List, Optional, Tuple
+import httpx
+from openai import (OpenAI, AsyncOpenAI, DefaultHttpxClient, DefaultAsyncHttpxClient,
+                    APIConnectionError, APIStatusError, APITimeoutError,
+                    InternalServerError, RateLimitError)
 from prompt_toolkit import PromptSession
+from prompt_toolkit.application import get_app, get_app_or_none, run_in_terminal
 from prompt_toolkit.auto_suggest import AutoSuggest, Suggestion
+from prompt_toolkit.completion import Completer, Completion
 from prompt_toolkit.key_binding import KeyBindings
 from prompt_toolkit.formatted_text import HTML
 from prompt_toolkit.styles import Style
 from dotenv import load_dotenv
-import platform
 
-load_dotenv()
+try:
+    import h2  # noqa: F401  (optional, enables HTTP/2 in httpx)
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
+
+try:
+    import fcntl
+    import termios
+    import tty
+    PTY_AVAILABLE = True
+except ImportError:  # Windows
+    PTY_AVAILABLE = False
+
+load_dotenv()
+
+# At the top of your file, add this debug print
+print("Using OpenRouter API key:", os.getenv("deepseek_api")[:8] + "..." if os.getenv("deepseek_api") else "Not found")
+
+FALLBACK_MODEL = "openai/gpt-3.5-turbo:free"
+HEDGE_MODEL = "meta-llama/llama-3.1-8b-instruct:free"
+
+# Suggestions and ? translations race a second model once the first one has
+# taken longer than this percentile of its own observed latency
+HEDGE_PERCENTILE = 0.9
+
+# Render suggestions token-by-token as they stream in
+STREAM_SUGGESTIONS = True
+MAX_FRAME_RATE = 30  # redraws per second for the whole prompt; 0 removes the cap
+
+# Alternatives requested per suggestion call, browsed locally with Alt+N / Alt+P
+SUGGESTION_CANDIDATES = 3
+
+API_BASE_URL = "https://openrouter.ai/api/v1"
+
+# Per call type timeouts; keystroke suggestions are useless once they are late
+CALL_TIMEOUTS = {
+    "probe": 5.0,
+    "suggestion": 3.0,
+    "prefetch": 5.0,
+    "translate": 15.0,
+    "analysis": 30.0,
+    "setup": 90.0,
+}
+CONNECT_TIMEOUT = 3.0
+
+
+class ConnectionStats:
+    """Counts requests against newly opened connections via httpcore's trace hook"""
+
+    def __init__(self):
+        self.requests = 0
+        self.connections = 0
+        self.http_versions = {}
+        self._lock = threading.Lock()
+
+    def trace(self, event_name: str, info: Dict):
+        with self._lock:
+            if event_name == "connection.connect_tcp.complete":
+                self.connections += 1
+            elif event_name.endswith("send_request_headers.started"):
+                self.requests += 1
+                version = event_name.split(".", 1)[0]
+                self.http_versions[version] = self.http_versions.get(version, 0) + 1
+
+    async def atrace(self, event_name: str, info: Dict):
+        self.trace(event_name, info)
+
+    def on_request(self, request: httpx.Request):
+        request.extensions["trace"] = self.trace
+
+    async def on_async_request(self, request: httpx.Request):
+        request.extensions["trace"] = self.atrace
+
+    def stats(self) -> Dict:
+        reused = max(0, self.requests - self.connections)
+        return {
+            "requests": self.requests,
+            "connections": self.connections,
+            "reused": reused,
+            "reuse_rate": reused / self.requests if self.requests else 0.0,
+            "http_versions": dict(self.http_versions),
+        }
+
+
+connection_stats = ConnectionStats()
+
+http_client = DefaultHttpxClient(
+    http2=HTTP2_AVAILABLE,
+    limits=httpx.Limits(max_connections=10, max_keepalive_connections=5, keepalive_expiry=120.0),
+    timeout=httpx.Timeout(CALL_TIMEOUTS["probe"], connect=CONNECT_TIMEOUT),
+    event_hooks={"request": [connection_stats.on_request]},
+)
+
+client = OpenAI(
+    base_url=API_BASE_URL,
+    api_key=os.getenv("deepseek_api"),
+    http_client=http_client,
+    max_retries=0,  # retries are handled by ResilientClient
+    default_headers={
+        "HTTP-Referer": "https://openrouter.ai/",  # Required for OpenRouter
+    }
+)
+
+# Keystroke suggestions run on prompt_toolkit's event loop with their own pool
+async_http_client = DefaultAsyncHttpxClient(
+    http2=HTTP2_AVAILABLE,
+    limits=httpx.Limits(max_connections=10, max_keepalive_connections=5, keepalive_expiry=120.0),
+    timeout=httpx.Timeout(CALL_TIMEOUTS["suggestion"], connect=CONNECT_TIMEOUT),
+    event_hooks={"request": [connection_stats.on_async_request]},
+)
+
+async_client = AsyncOpenAI(
+    base_url=API_BASE_URL,
+    api_key=os.getenv("deepseek_api"),
+    http_client=async_http_client,
+    max_retries=0,
+    default_headers={
+        "HTTP-Referer": "https://openrouter.ai/",  # Required for OpenRouter
+    }
+)
+
+
+class LLMUnavailableError(Exception):
+    """Raised instead of sending a request the rate limiter or circuit breaker refused"""
+
+
+class TokenBucket:
+    """Classic token bucket: ``rate`` tokens per second, up to ``capacity`` banked"""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def try_acquire(self) -> bool:
+        with self._lock:
+            self._refill(time.monotonic())
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return True
+            return False
+
+    def acquire(self, timeout: float) -> bool:
+        """Wait up to timeout seconds for a token"""
+        deadline = time.monotonic() + timeout
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._refill(now)
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return True
+                wait = (1 - self.tokens) / self.rate
+            if now + wait > deadline:
+                return False
+            time.sleep(wait)
+
+
+class CircuitBreaker:
+    """Opens after consecutive failures and lets one trial request through after a cool-down"""
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half-open"
+    TRIAL_TIMEOUT = 10.0  # seconds before an unresolved trial is given up and another allowed
+    RETRIAL_COOLDOWN = 1.0  # seconds before a new trial once one was cancelled or dropped
+
+    def __init__(self, failure_threshold: int = 3, cooldown: float = 30.0):
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_until = 0.0
+        self.trial_deadline = 0.0
+        self.trips = 0
+        self._lock = threading.Lock()
+
+    def allow(self) -> bool:
+        with self._lock:
+            if self.state == self.CLOSED:
+                return True
+            now = time.monotonic()
+            if ((self.state == self.OPEN and now >= self.opened_until)
+                    or (self.state == self.HALF_OPEN and now >= self.trial_deadline)):
+                self.state = self.HALF_OPEN
+                self.trial_deadline = now + self.TRIAL_TIMEOUT
+                return True
+            return False
+
+    def abandon_trial(self):
+        """A trial that ended without an answer (cancelled or dropped) proves nothing; retry it soon"""
+        with self._lock:
+            if self.state == self.HALF_OPEN:
+                self.state = self.OPEN
+                self.opened_until = time.monotonic() + self.RETRIAL_COOLDOWN
+
+    def record_success(self):
+        with self._lock:
+            self.state = self.CLOSED
+            self.failures = 0
+
+    def record_failure(self, cooldown: Optional[float] = None):
+        """Count a failure; a server-provided cooldown opens the circuit immediately"""
+        with self._lock:
+            self.failures += 1
+            if cooldown is not None or self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+                if self.state != self.OPEN:
+                    self.trips += 1
+                self.state = self.OPEN
+                self.opened_until = time.monotonic() + max(cooldown or 0.0, self.cooldown)
+
+
+def _retry_after(error: Exception) -> Optional[float]:
+    """Seconds the server asked us to wait, from Retry-After(-Ms) headers"""
+    response = getattr(error, "response", None)
+    if response is None:
+        return None
+    headers = response.headers
+    try:
+        if headers.get("retry-after-ms"):
+            return float(headers["retry-after-ms"]) / 1000
+        value = headers.get("retry-after")
+        if not value:
+            return None
+        try:
+            return float(value)
+        except ValueError:
+            return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+# Scheduling classes for LLM traffic, highest priority first
+CALL_PRIORITIES = {
+    "suggestion": "interactive",
+    "translate": "foreground",
+    "analysis": "foreground",
+    "setup": "background",
+    "prefetch": "background",
+    "probe": "background",
+}
+PRIORITY_ORDER = ("interactive", "foreground", "background")
+CLASS_CONCURRENCY = {"interactive": 2, "foreground": 2, "background": 1}
+TOTAL_CONCURRENCY = 4
+
+
+class _Waiter:
+    __slots__ = ("priority_class", "enqueued", "wake", "granted", "abandoned")
+
+    def __init__(self, priority_class: str, wake):
+        self.priority_class = priority_class
+        self.enqueued = time.monotonic()
+        self.wake = wake
+        self.granted = False
+        self.abandoned = False
+
+
+class RequestScheduler:
+    """Grants request slots by priority class under per-class and total concurrency caps.
+
+    Threads and asyncio tasks wait in the same priority queue; a freed slot
+    goes to the highest-priority waiter whose class is still under its cap,
+    so a long background batch can never hold the slots interactive
+    suggestions need. ``acquire`` returns an idempotent release callable.
+    """
+
+    def __init__(self, total: int = TOTAL_CONCURRENCY, limits: Dict = CLASS_CONCURRENCY):
+        self.total = total
+        self.limits = dict(limits)
+        self.active = {cls: 0 for cls in PRIORITY_ORDER}
+        self._queue = []  # heap of (priority, seq, waiter)
+        self._seq = itertools.count()
+        self._lock = threading.Lock()
+        self.granted = {cls: 0 for cls in PRIORITY_ORDER}
+        self.queued = {cls: 0 for cls in PRIORITY_ORDER}
+        self.max_depth = {cls: 0 for cls in PRIORITY_ORDER}
+        self.wait_time = {cls: 0.0 for cls in PRIORITY_ORDER}
+
+    def _class_of(self, call_type: str) -> str:
+        return CALL_PRIORITIES.get(call_type, "foreground")
+
+    def _has_room(self, priority_class: str) -> bool:
+        return (sum(self.active.values()) < self.total
+                and self.active[priority_class] < self.limits[priority_class])
+
+    def _grant(self, waiter: _Waiter):
+        waiter.granted = True
+        self.active[waiter.priority_class] += 1
+        self.granted[waiter.priority_class] += 1
+        self.wait_time[waiter.priority_class] += time.monotonic() - waiter.enqueued
+
+    def _dispatch(self):
+        """Hand free slots to queued waiters in priority order (lock held)"""
+        skipped = []
+        while self._queue:
+            entry = heapq.heappop(self._queue)
+            waiter = entry[2]
+            if waiter.abandoned:
+                continue
+            if not self._has_room(waiter.priority_class):
+                skipped.append(entry)
+                continue
+            self.queued[waiter.priority_class] -= 1
+            self._grant(waiter)
+            waiter.wake()
+        for entry in skipped:
+            heapq.heappush(self._queue, entry)
+
+    def _enqueue(self, call_type: str, wake) -> _Waiter:
+        priority_class = self._class_of(call_type)
+        waiter = _Waiter(priority_class, wake)
+        with self._lock:
+            heapq.heappush(self._queue, (PRIORITY_ORDER.index(priority_class), next(self._seq), waiter))
+            self.queued[priority_class] += 1
+            self._dispatch()
+            self.max_depth[priority_class] = max(self.max_depth[priority_class], self.queued[priority_class])
+        return waiter
+
+    def _releaser(self, waiter: _Waiter):
+        released = []
+
+        def release():
+            with self._lock:
+                if released:
+                    return
+                released.append(True)
+                self.active[waiter.priority_class] -= 1
+                self._dispatch()
+        return release
+
+    def _abandon(self, waiter: _Waiter):
+        with self._lock:
+            if not waiter.granted:
+                waiter.abandoned = True
+                self.queued[waiter.priority_class] -= 1
+                return True
+        return False
+
+    def acquire(self, call_type: str, timeout: float = 30.0):
+        """Block the calling thread until a slot is free, for at most timeout seconds"""
+        event = threading.Event()
+        waiter = self._enqueue(call_type, event.set)
+        if not waiter.granted and not event.wait(timeout) and self._abandon(waiter):
+            raise LLMUnavailableError("no request slot free")
+        return self._releaser(waiter)
+
+    async def acquire_async(self, call_type: str):
+        """Wait on the event loop until a slot is free; cancelling gives up the place in the queue"""
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+
+        def wake():
+            loop.call_soon_threadsafe(lambda: future.done() or future.set_result(None))
+
+        waiter = self._enqueue(call_type, wake)
+        release = self._releaser(waiter)
+        if not waiter.granted:
+            try:
+                await future
+            except asyncio.CancelledError:
+                if not self._abandon(waiter):
+                    release()
+                raise
+        return release
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {
+                cls: {
+                    "active": self.active[cls],
+                    "limit": self.limits[cls],
+                    "queued": self.queued[cls],
+                    "max_depth": self.max_depth[cls],
+                    "granted": self.granted[cls],
+                    "avg_wait": self.wait_time[cls] / self.granted[cls] if self.granted[cls] else 0.0,
+                }
+                for cls in PRIORITY_ORDER
+            }
+
+
+scheduler = RequestScheduler()
+
+
+class _ScheduledStream:
+    """Holds a scheduler slot for as long as a streamed response is open"""
+
+    def __init__(self, stream, release):
+        self._stream = stream
+        self._release = release
+
+    def __iter__(self):
+        return iter(self._stream)
+
+    def __aiter__(self):
+        return self._stream.__aiter__()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        try:
+            self._stream.close()
+        finally:
+            self._release()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        try:
+            await self._stream.close()
+        finally:
+            self._release()
+
+
+class ResilientClient:
+    """Shared front door for chat completions with rate limiting, backoff and a circuit breaker.
+
+    Keystroke suggestions are best-effort: they are dropped rather than
+    queued when the bucket is empty, never retried, and refused outright
+    while the circuit is open. Foreground calls wait for a token and retry
+    transient errors with exponential backoff, honouring Retry-After.
+    """
+
+    RETRYABLE = (RateLimitError, APIConnectionError, APITimeoutError, InternalServerError)
+    BEST_EFFORT = ("suggestion", "prefetch", "probe")
+    MAX_RETRIES = 3
+    BACKOFF_BASE = 0.5
+    BACKOFF_CAP = 8.0
+
+    def __init__(self, client, async_client, rate: float = 2.0, burst: float = 6.0):
+        self.client = client
+        self.async_client = async_client
+        self.bucket = TokenBucket(rate, burst)
+        self.breaker = CircuitBreaker()
+        self.sent = 0
+        self.dropped = 0
+        self.retries = 0
+        self.failures = 0
+        self.last_error = None
+
+    def _admit(self, call_type: str, kwargs: Dict) -> bool:
+        """Apply the call type's timeout and admission rules; True for best-effort calls"""
+        timeout = CALL_TIMEOUTS.get(call_type, CALL_TIMEOUTS["translate"])
+        kwargs.setdefault("timeout", httpx.Timeout(timeout, connect=min(timeout, CONNECT_TIMEOUT)))
+        best_effort = call_type in self.BEST_EFFORT
+        if best_effort:
+            if not self.breaker.allow():
+                self.dropped += 1
+                raise LLMUnavailableError("circuit open, AI suggestions paused")
+            if not self.bucket.try_acquire():
+                self.dropped += 1
+                self.breaker.abandon_trial()
+                raise LLMUnavailableError("rate limited locally")
+        return best_effort
+
+    def _record_failure(self, error: Exception, attempt: int, retries: int) -> float:
+        """Account for a failed attempt and return the delay before the next one"""
+        self.failures += 1
+        self.last_error = error
+        if not isinstance(error, self.RETRYABLE):
+            self.breaker.abandon_trial()
+            raise error
+        retry_after = _retry_after(error)
+        self.breaker.record_failure(retry_after if isinstance(error, RateLimitError) else None)
+        if attempt == retries:
+            raise error
+        self.retries += 1
+        return retry_after or random.uniform(0, min(self.BACKOFF_CAP, self.BACKOFF_BASE * 2 ** attempt))
+
+    @staticmethod
+    def _backoff(delay: float, cancelled: Optional[threading.Event]):
+        if cancelled is None:
+            time.sleep(delay)
+        elif cancelled.wait(delay):
+            raise LLMUnavailableError("request cancelled")
+
+    def create(self, call_type: str, cancelled: Optional[threading.Event] = None, **kwargs):
+        """Blocking call; once ``cancelled`` is set no further attempt or backoff is made"""
+        best_effort = self._admit(call_type, kwargs)
+        if not best_effort and not self.bucket.acquire(timeout=30.0):
+            raise LLMUnavailableError("rate limited locally")
+
+        retries = 0 if best_effort else self.MAX_RETRIES
+        for attempt in range(retries + 1):
+            if cancelled is not None and cancelled.is_set():
+                self.breaker.abandon_trial()
+                raise LLMUnavailableError("request cancelled")
+            try:
+                release = scheduler.acquire(call_type)
+            except LLMUnavailableError:
+                self.breaker.abandon_trial()
+                raise
+            try:
+                self.sent += 1
+                result = self.client.chat.completions.create(**kwargs)
+                self.breaker.record_success()
+                if kwargs.get("stream"):
+                    return _ScheduledStream(result, release)
+                release()
+                return result
+            except APIStatusError as e:
+                release()
+                self._backoff(self._record_failure(e, attempt, retries), cancelled)
+            except self.RETRYABLE as e:
+                release()
+                self._backoff(self._record_failure(e, attempt, retries), cancelled)
+            except BaseException:
+                release()
+                self.breaker.abandon_trial()
+                raise
+
+    async def acreate(self, call_type: str, **kwargs):
+        """``create`` for the event loop, using the AsyncOpenAI client; cancellable at any await"""
+        best_effort = self._admit(call_type, kwargs)
+        if not best_effort:
+            deadline = time.monotonic() + 30.0
+            while not self.bucket.try_acquire():
+                if time.monotonic() > deadline:
+                    raise LLMUnavailableError("rate limited locally")
+                await asyncio.sleep(1 / self.bucket.rate)
+
+        retries = 0 if best_effort else self.MAX_RETRIES
+        for attempt in range(retries + 1):
+            release = await scheduler.acquire_async(call_type)
+            try:
+                self.sent += 1
+                result = await self.async_client.chat.completions.create(**kwargs)
+                self.breaker.record_success()
+                if kwargs.get("stream"):
+                    return _ScheduledStream(result, release)
+                release()
+                return result
+            except APIStatusError as e:
+                release()
+                await asyncio.sleep(self._record_failure(e, attempt, retries))
+            except self.RETRYABLE as e:
+                release()
+                await asyncio.sleep(self._record_failure(e, attempt, retries))
+            except BaseException:
+                release()
+                self.breaker.abandon_trial()
+                raise
+
+    def stats(self) -> Dict:
+        return {
+            "sent": self.sent,
+            "dropped": self.dropped,
+            "retries": self.retries,
+            "failures": self.failures,
+            "circuit": self.breaker.state,
+            "trips": self.breaker.trips,
+            "last_error": str(self.last_error) if self.last_error else None,
+        }
+
+
+llm = ResilientClient(client, async_client)
+
+class ConnectionState:
+    """Thread-safe result of the background API health probe"""
+
+    UNKNOWN = "unknown"
+    OK = "ok"
+    FAILED = "failed"
+
+    RECHECK_INTERVAL = 30.0  # seconds before a failed probe is retried
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._done = threading.Event()
+        self._probing = False
+        self.status = self.UNKNOWN
+        self.error = None
+        self.latency = None
+        self.checked_at = 0.0
+
+    def begin_probe(self) -> bool:
+        """Claim the right to run a probe; False if one is already running"""
+        with self._lock:
+            if self._probing:
+                return False
+            self._probing = True
+            return True
+
+    def update(self, ok: bool, error: Optional[str] = None, latency: Optional[float] = None):
+        with self._lock:
+            self.status = self.OK if ok else self.FAILED
+            self.error = error
+            self.latency = latency
+            self.checked_at = time.time()
+            self._probing = False
+        self._done.set()
+
+    def wait(self, timeout: Optional[float] = None) -> bool:
+        """Block until the first probe has finished"""
+        return self._done.wait(timeout)
+
+    @property
+    def is_ok(self) -> bool:
+        return self.status == self.OK
+
+    @property
+    def is_failed(self) -> bool:
+        return self.status == self.FAILED
+
+    def usable(self) -> bool:
+        """Whether AI calls are worth attempting right now.
+
+        A failed probe suppresses calls until RECHECK_INTERVAL has passed, at
+        which point a fresh probe is started in the background.
+        """
+        if not self.is_failed:
+            return True
+        if time.time() - self.checked_at >= self.RECHECK_INTERVAL:
+            start_api_probe()
+        return False
+
+    def describe(self) -> str:
+        if self.is_ok:
+            return f"connected ({self.latency * 1000:.0f} ms)"
+        if self.is_failed:
+            return f"unreachable ({self.error})"
+        return "checking..."
+
+
+api_state = ConnectionState()
+
+# Test the API connection
+def test_api_connection():
+    start = time.perf_counter()
+    try:
+        completion = llm.create(
+            "probe",
+            model=FALLBACK_MODEL,
+            messages=[
+                {"role": "system", "content": "You are a helpful assistant."},
+                {"role": "user", "content": "Say 'API connection successful'"}
+            ],
+            max_tokens=10
+        )
+        if not completion or not completion.choices:
+            api_state.update(False, "empty response")
+            return False
+        api_state.update(True, latency=time.perf_counter() - start)
+        return True
+    except Exception as e:
+        api_state.update(False, str(e))
+        return False
+
+def start_api_probe():
+    """Run test_api_connection in the background so startup never waits on the network"""
+    if not api_state.begin_probe():
+        return None
+    thread = threading.Thread(target=test_api_connection, daemon=True)
+    thread.start()
+    return thread
+
+def warm_connection():
+    """Open a pooled keep-alive connection so the first real request skips DNS, TCP and TLS"""
+    try:
+        http_client.head(f"{API_BASE_URL}/models", timeout=CALL_TIMEOUTS["probe"])
+    except httpx.HTTPError:
+        pass
+
+async def warm_async_connection():
+    """Same as warm_connection for the event loop's pool used by suggestions"""
+    try:
+        await async_http_client.head(f"{API_BASE_URL}/models", timeout=CALL_TIMEOUTS["probe"])
+    except httpx.HTTPError:
+        pass
+
+def warn_if_api_unavailable():
+    """Tell the user about a failed probe before a foreground AI call"""
+    if api_state.is_failed:
+        print(f"Warning: OpenRouter API {api_state.describe()}; trying anyway...")
+
+# Call this at startup
+threading.Thread(target=warm_connection, daemon=True).start()
+start_api_probe()
+
+
+# Global state management
+command_history = []
+
+
+class SuggestionCache:
+    """Bounded LRU cache of AI suggestions with a TTL and prefix-extension lookup.
+
+    Entries are keyed by the text that was sent to the model and hold every
+    candidate the model returned for it. A lookup for ``git che`` can be
+    answered by the entry for ``git ch`` as long as one of its candidates
+    still starts with the longer text.
+    """
+
+    def __init__(self, max_entries: int = 512, ttl: float = 600.0):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()  # prefix -> (candidates, stored_at)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.speculative = {}  # unused prefetched prefix -> the prefetch request it came from
+        self.speculative_hits = 0
+
+    def put(self, prefix: str, candidates, speculative: Optional[str] = None):
+        """Store candidates for prefix.
+
+        ``speculative`` names the prefetch request (its prefix) an entry came
+        from; the first hit on any entry of a request counts once for it.
+        """
+        if isinstance(candidates, str):
+            candidates = [candidates]
+        candidates = tuple(c for c in candidates if c)
+        if not candidates:
+            return
+        with self._lock:
+            if speculative:
+                self.speculative[prefix] = speculative
+            else:
+                self.speculative.pop(prefix, None)
+            self._entries[prefix] = (candidates, time.monotonic())
+            self._entries.move_to_end(prefix)
+            while len(self._entries) > self.max_entries:
+                evicted, _ = self._entries.popitem(last=False)
+                self.speculative.pop(evicted, None)
+
+    def _fresh(self, prefix: str, now: float) -> tuple:
+        entry = self._entries.get(prefix)
+        if entry is None:
+            return ()
+        candidates, stored_at = entry
+        if now - stored_at > self.ttl:
+            del self._entries[prefix]
+            self.speculative.pop(prefix, None)
+            return ()
+        return candidates
+
+    def candidates(self, text: str, count: bool = True) -> List[str]:
+        """Cached candidates that extend ``text``, taken from the longest matching prefix"""
+        now = time.monotonic()
+        with self._lock:
+            for end in range(len(text), 0, -1):
+                prefix = text[:end]
+                matches = [c for c in self._fresh(prefix, now) if c.startswith(text) and c != text]
+                if matches:
+                    self._entries.move_to_end(prefix)
+                    if count:
+                        self.hits += 1
+                        if prefix in self.speculative:
+                            request = self.speculative[prefix]
+                            for filed in [p for p, r in self.speculative.items() if r == request]:
+                                del self.speculative[filed]
+                            self.speculative_hits += 1
+                    return matches
+            if count:
+                self.misses += 1
+            return []
+
+    def lookup(self, text: str, count: bool = True) -> Optional[str]:
+        """Return the best cached suggestion that extends ``text``"""
+        matches = self.candidates(text, count)
+        return matches[0] if matches else None
+
+    def stats(self) -> Dict:
+        total = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+        }
+
+
+suggestion_cache = SuggestionCache()
+
+
+class DiskCache:
+    """SQLite cache of AI results shared by every shell session on the machine.
+
+    Rows are keyed by (kind, model, key) so switching models never serves
+    another model's answers. WAL mode plus a short busy timeout lets several
+    terminals read and write concurrently; the table is trimmed to
+    ``max_rows`` by least-recent use.
+    """
+
+    MAX_ERRORS = 3  # consecutive non-busy failures before the cache is switched off
+    BUSY_TIMEOUT = 0.25  # a locked database is a miss, so never wait long for it
+
+    def __init__(self, path: Path, max_rows: int = 5000, ttl: float = 30 * 24 * 3600.0):
+        self.path = path
+        self.max_rows = max_rows
+        self.ttl = ttl
+        self._conn = None
+        self._lock = threading.Lock()
+        self._puts = 0
+        self._errors = 0
+        self.busy = 0
+        self.disabled = False
+        self.hits = 0
+        self.misses = 0
+
+    def _connection(self):
+        if self._conn is None:
+            conn = sqlite3.connect(str(self.path), timeout=self.BUSY_TIMEOUT,
+                                   check_same_thread=False, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("""CREATE TABLE IF NOT EXISTS cache (
+                kind TEXT NOT NULL,
+                model TEXT NOT NULL,
+                key TEXT NOT NULL,
+                value TEXT NOT NULL,
+                created REAL NOT NULL,
+                used REAL NOT NULL,
+                PRIMARY KEY (kind, model, key))""")
+            conn.execute("CREATE INDEX IF NOT EXISTS cache_used ON cache (used)")
+            self._conn = conn
+        return self._conn
+
+    def _execute(self, sql: str, params=()):
+        """Run a statement, treating failures as misses instead of failing the caller.
+
+        A busy or locked database (another terminal holding the write lock)
+        only skips this statement; the cache is disabled once errors of any
+        other kind repeat ``MAX_ERRORS`` times in a row.
+        """
+        if self.disabled:
+            return None
+        with self._lock:
+            try:
+                rows = self._connection().execute(sql, params).fetchall()
+            except sqlite3.OperationalError as e:
+                message = str(e).lower()
+                if "locked" in message or "busy" in message:
+                    self.busy += 1
+                    return None
+                self._failed()
+                return None
+            except sqlite3.Error:
+                self._failed()
+                return None
+            self._errors = 0
+            return rows
+
+    def _failed(self):
+        self._errors += 1
+        if self._errors >= self.MAX_ERRORS:
+            self.disabled = True
+
+    def get(self, kind: str, key: str, model: str = FALLBACK_MODEL) -> Optional[str]:
+        rows = self._execute(
+            "SELECT value FROM cache WHERE kind = ? AND model = ? AND key = ? AND created > ?",
+            (kind, model, key, time.time() - self.ttl))
+        if not rows:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._execute("UPDATE cache SET used = ? WHERE kind = ? AND model = ? AND key = ?",
+                      (time.time(), kind, model, key))
+        return rows[0][0]
+
+    def lookup_prefix(self, kind: str, text: str, model: str = FALLBACK_MODEL) -> List[str]:
+        """Return the lines of the value stored under the longest prefix of text that extend it.
+
+        Values may hold several newline-separated candidates.
+        """
+        prefixes = [text[:end] for end in range(len(text), 0, -1)]
+        if not prefixes:
+            return []
+        rows = self._execute(
+            f"SELECT key, value FROM cache WHERE kind = ? AND model = ? AND created > ? "
+            f"AND key IN ({','.join('?' * len(prefixes))}) ORDER BY length(key) DESC",
+            (kind, model, time.time() - self.ttl, *prefixes))
+        for _, value in rows or ():
+            matches = [line for line in value.split("\n") if line.startswith(text) and line != text]
+            if matches:
+                self.hits += 1
+                return matches
+        self.misses += 1
+        return []
+
+    def put(self, kind: str, key: str, value: str, model: str = FALLBACK_MODEL, keep_empty: bool = False):
+        if not value and not keep_empty:
+            return
+        now = time.time()
+        self._execute("INSERT OR REPLACE INTO cache VALUES (?, ?, ?, ?, ?, ?)",
+                      (kind, model, key, value, now, now))
+        self._puts += 1
+        if self._puts % 100 == 0:
+            self.evict()
+
+    def evict(self):
+        self._execute(
+            "DELETE FROM cache WHERE used <= (SELECT used FROM cache ORDER BY used DESC LIMIT 1 OFFSET ?)",
+            (self.max_rows,))
+
+    def recent(self, kind: str, limit: int, model: str = FALLBACK_MODEL) -> List:
+        """Most recently used (key, value) pairs, newest last"""
+        rows = self._execute(
+            "SELECT key, value FROM cache WHERE kind = ? AND model = ? AND created > ? "
+            "ORDER BY used DESC LIMIT ?",
+            (kind, model, time.time() - self.ttl, limit))
+        return list(reversed(rows or []))
+
+    def stats(self) -> Dict:
+        rows = self._execute("SELECT COUNT(*) FROM cache")
+        return {
+            "rows": rows[0][0] if rows else 0,
+            "hits": self.hits,
+            "misses": self.misses,
+            "busy": self.busy,
+            "disabled": self.disabled,
+        }
+
+
+disk_cache = DiskCache(Path.home() / ".aishell_cache.sqlite3")
+
+def warm_suggestion_cache():
+    """Seed the in-memory suggestion cache from disk so the first keystroke can hit"""
+    for prefix, value in disk_cache.recent("suggestion", suggestion_cache.max_entries):
+        suggestion_cache.put(prefix, value.split("\n"))
+
+
+HISTORY_FILE = Path.home() / ".aishell_history"
+HISTORY_LIMIT = 5000  # most recent commands loaded, and kept on disk
+
+
+class _RadixNode:
+    __slots__ = ("children", "top")
+
+    def __init__(self):
+        self.children = {}  # first char of edge -> (edge label, child node)
+        self.top = []  # best-ranked commands in this subtree
+
+
+class HistoryTrie:
+    """Radix tree over command history, ranked by frequency and recency.
+
+    Each node keeps the TOP_K best commands of its subtree so a lookup is a
+    walk down the typed prefix followed by scoring a handful of candidates.
+    """
+
+    TOP_K = 4
+    HALF_LIFE = 7 * 24 * 3600.0  # recency weight halves every week
+    MIN_CONFIDENCE = 0.5  # best candidate's share of the subtree's score
+
+    def __init__(self):
+        self._root = _RadixNode()
+        self._commands = {}  # command -> [count, last_used]
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._commands)
+
+    def _score(self, command: str, now: float) -> float:
+        count, last_used = self._commands[command]
+        return count * 0.5 ** (max(0.0, now - last_used) / self.HALF_LIFE)
+
+    def _offer(self, node: _RadixNode, command: str, now: float):
+        if command not in node.top:
+            node.top.append(command)
+            if len(node.top) > self.TOP_K:
+                node.top.remove(min(node.top, key=lambda c: self._score(c, now)))
+
+    def add(self, command: str, timestamp: Optional[float] = None):
+        command = command.strip()
+        if not command:
+            return
+        now = timestamp or time.time()
+        with self._lock:
+            entry = self._commands.setdefault(command, [0, now])
+            entry[0] += 1
+            entry[1] = max(entry[1], now)
+
+            node, rest = self._root, command
+            self._offer(node, command, now)
+            while rest:
+                edge = node.children.get(rest[0])
+                if edge is None:
+                    leaf = _RadixNode()
+                    node.children[rest[0]] = (rest, leaf)
+                    self._offer(leaf, command, now)
+                    return
+                label, child = edge
+                common = len(os.path.commonprefix([label, rest]))
+                if common < len(label):
+                    # Split the edge so the shared part gets its own node
+                    middle = _RadixNode()
+                    middle.top = list(child.top)
+                    middle.children[label[common]] = (label[common:], child)
+                    node.children[rest[0]] = (label[:common], middle)
+                    child = middle
+                self._offer(child, command, now)
+                node, rest = child, rest[common:]
+
+    def _candidates(self, prefix: str) -> List[str]:
+        node, rest = self._root, prefix
+        while rest:
+            edge = node.children.get(rest[0])
+            if edge is None:
+                return []
+            label, child = edge
+            if label.startswith(rest):
+                node, rest = child, ""
+            elif rest.startswith(label):
+                node, rest = child, rest[len(label):]
+            else:
+                return []
+        return [c for c in node.top if c != prefix and c.startswith(prefix)]
+
+    def next_tokens(self, prefix: str, limit: int = 3) -> List[str]:
+        """Most likely words to follow prefix (which must end on a word boundary)"""
+        if prefix and not prefix.endswith(" "):
+            return []
+        now = time.time()
+        ranked = {}
+        with self._lock:
+            for command in self._candidates(prefix):
+                rest = command[len(prefix):].split()
+                if rest:
+                    ranked[rest[0]] = ranked.get(rest[0], 0.0) + self._score(command, now)
+        return sorted(ranked, key=ranked.get, reverse=True)[:limit]
+
+    def lookup(self, prefix: str, count: bool = True) -> Optional[str]:
+        """Return the best history completion for prefix, if it is a confident one"""
+        if not prefix.strip():
+            return None
+        now = time.time()
+        with self._lock:
+            candidates = self._candidates(prefix)
+            if candidates:
+                scores = {c: self._score(c, now) for c in candidates}
+                best = max(scores, key=scores.get)
+                # Having run exactly the typed text counts against completing it further
+                total = sum(scores.values())
+                if prefix in self._commands:
+                    total += self._score(prefix, now)
+                if scores[best] > self.MIN_CONFIDENCE * total:
+                    self.hits += count
+                    return best
+            self.misses += count
+            return None
+
+    def ranked(self, prefix: str, limit: int = 5) -> List[str]:
+        """History completions for prefix, best first, without a confidence threshold"""
+        if not prefix.strip():
+            return []
+        now = time.time()
+        with self._lock:
+            candidates = self._candidates(prefix)
+            return sorted(candidates, key=lambda c: self._score(c, now), reverse=True)[:limit]
+
+    def clear(self):
+        with self._lock:
+            self._root = _RadixNode()
+            self._commands = {}
+
+    def stats(self) -> Dict:
+        return {"commands": len(self._commands), "hits": self.hits, "misses": self.misses}
+
+
+command_trie = HistoryTrie()
+
+def load_history():
+    """Load persisted history into command_history and command_trie"""
+    try:
+        with open(HISTORY_FILE, "r", errors="replace") as f:
+            lines = f.readlines()
+    except OSError:
+        return
+    if len(lines) > HISTORY_LIMIT:
+        # Trim the file too, as bash does with HISTFILESIZE, so it stops growing without bound
+        lines = lines[-HISTORY_LIMIT:]
+        trimmed = HISTORY_FILE.with_name(HISTORY_FILE.name + ".tmp")
+        try:
+            with open(trimmed, "w") as f:
+                f.writelines(lines)
+            os.replace(trimmed, HISTORY_FILE)
+        except OSError:
+            pass
+    for line in lines:
+        timestamp, _, command = line.rstrip("\n").partition("\t")
+        try:
+            timestamp = float(timestamp)
+        except ValueError:
+            continue
+        if command:
+            command_history.append(command)
+            command_trie.add(command, timestamp)
+
+def record_command(command: str):
+    """Remember an executed command in memory, in the trie and on disk"""
+    command_history.append(command)
+    command_trie.add(command)
+    try:
+        with open(HISTORY_FILE, "a") as f:
+            f.write(f"{time.time():.0f}\t{command}\n")
+    except OSError:
+        pass
+
+def clear_history():
+    """Forget every command, in memory, in the trie and on disk"""
+    command_history.clear()
+    command_trie.clear()
+    try:
+        open(HISTORY_FILE, "w").close()
+    except OSError:
+        pass
+
+class LatencyHistogram:
+    """Log-bucketed latency histogram (10 ms .. ~40 s) with percentile lookup"""
+
+    BOUNDS = [0.01 * 1.25 ** i for i in range(38)]
+
+    def __init__(self):
+        self.counts = [0] * (len(self.BOUNDS) + 1)
+        self.total = 0
+
+    def record(self, seconds: float):
+        self.counts[bisect.bisect_left(self.BOUNDS, seconds)] += 1
+        self.total += 1
+
+    def percentile(self, fraction: float) -> float:
+        if not self.total:
+            return 0.0
+        target = fraction * self.total
+        seen = 0
+        for i, count in enumerate(self.counts):
+            seen += count
+            if seen >= target:
+                return self.BOUNDS[min(i, len(self.BOUNDS) - 1)]
+        return self.BOUNDS[-1]
+
+
+class RequestHedger:
+    """Races a duplicate request on a second model when the first one is slow.
+
+    ``attempt(model, cancelled)`` performs one request and must give up
+    promptly once the ``cancelled`` event is set. The primary model starts
+    immediately; if it has not produced a valid answer after its
+    HEDGE_PERCENTILE latency (taken from its own histogram), or fails
+    outright, the next model is started too. The first valid answer wins and
+    every other attempt is cancelled.
+
+    ``arun`` is the event-loop flavour: attempts are coroutines and losers
+    are cancelled as asyncio tasks.
+    """
+
+    MIN_SAMPLES = 10  # below this the default delay is used
+    DEFAULT_DELAY = 1.5
+    MIN_DELAY = 0.2
+
+    def __init__(self, models: List[str], percentile: float = HEDGE_PERCENTILE):
+        self.models = models
+        self.percentile = percentile
+        self.histograms = {model: LatencyHistogram() for model in models}
+        self._executor = ThreadPoolExecutor(max_workers=2 * len(models), thread_name_prefix="hedge")
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.hedges = 0
+        self.wins = {model: 0 for model in models}
+        self.last_error = None
+
+    def hedge_delay(self, model: str) -> float:
+        histogram = self.histograms[model]
+        if histogram.total < self.MIN_SAMPLES:
+            return self.DEFAULT_DELAY
+        return max(self.MIN_DELAY, histogram.percentile(self.percentile))
+
+    def _timed(self, model, attempt, cancelled, results):
+        start = time.monotonic()
+        try:
+            value = attempt(model, cancelled)
+        except Exception as e:
+            self.last_error = e
+            value = None
+        elapsed = time.monotonic() - start
+        if value and not cancelled.is_set():
+            with self._lock:
+                self.histograms[model].record(elapsed)
+        results.put((model, value))
+
+    def run(self, attempt):
+        """Return the first valid answer across models, or None"""
+        self.requests += 1
+        results = queue.Queue()
+        cancels = {}
+        pending = list(self.models)
+
+        def launch():
+            model = pending.pop(0)
+            cancels[model] = threading.Event()
+            self._executor.submit(self._timed, model, attempt, cancels[model], results)
+            return time.monotonic() + self.hedge_delay(model)
+
+        hedge_at = launch()
+        running = 1
+        try:
+            while running:
+                timeout = max(0.0, hedge_at - time.monotonic()) if pending else None
+                try:
+                    model, value = results.get(timeout=timeout)
+                except queue.Empty:
+                    if pending and time.monotonic() >= hedge_at:
+                        self.hedges += 1
+                        hedge_at = launch()
+                        running += 1
+                    continue
+                running -= 1
+                if value:
+                    self.wins[model] += 1
+                    return value
+                # Failed outright, fail over right away instead of waiting for the hedge delay
+                if pending and not running:
+                    hedge_at = launch()
+                    running += 1
+            return None
+        finally:
+            for event in cancels.values():
+                event.set()
+
+    async def _atimed(self, model, attempt):
+        start = time.monotonic()
+        try:
+            value = await attempt(model)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            self.last_error = e
+            return None
+        if value:
+            self.histograms[model].record(time.monotonic() - start)
+        return value
+
+    async def arun(self, attempt, hedge: bool = True):
+        """Return the first valid answer of ``await attempt(model)`` across models, or None.
+
+        With ``hedge`` off only the primary model is asked, so the call costs exactly one request.
+        """
+        self.requests += 1
+        pending = list(self.models if hedge else self.models[:1])
+        tasks = {}
+
+        def launch():
+            model = pending.pop(0)
+            tasks[asyncio.ensure_future(self._atimed(model, attempt))] = model
+            return time.monotonic() + self.hedge_delay(model)
+
+        hedge_at = launch()
+        try:
+            while tasks:
+                timeout = max(0.0, hedge_at - time.monotonic()) if pending else None
+                done, _ = await asyncio.wait(tasks, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    self.hedges += 1
+                    hedge_at = launch()
+                    continue
+                for task in done:
+                    model = tasks.pop(task)
+                    value = task.result()
+                    if value:
+                        self.wins[model] += 1
+                        return value
+                # Failed outright, fail over right away instead of waiting for the hedge delay
+                if pending and not tasks:
+                    hedge_at = launch()
+            return None
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    def stats(self) -> Dict:
+        return {
+            "requests": self.requests,
+            "hedges": self.hedges,
+            "models": {
+                model: {
+                    "wins": self.wins[model],
+                    "samples": self.histograms[model].total,
+                    "p50": self.histograms[model].percentile(0.5),
+                    "hedge_delay": self.hedge_delay(model),
+                }
+                for model in self.models
+            },
+        }
+
+
+hedger = RequestHedger([FALLBACK_MODEL, HEDGE_MODEL])
+
+def _clean_suggestion(user_input: str, raw: str) -> str:
+    """Reduce raw model output to a single command line that extends user_input"""
+    suggestion = raw.strip()
+    suggestion = suggestion.split("\n")[0].split("#")[0].strip().strip('"').strip("'")
+
+    # Ensure suggestion starts with user input
+    if suggestion and not suggestion.startswith(user_input):
+        suggestion = user_input + suggestion
+    elif suggestion == user_input:
+        suggestion += " "
+    return suggestion
+
+# Keystroke prompts are kept short: they go out on every suggestion request
+SUGGESTION_PROMPT = "Complete the shell command. Reply with the full command only, no explanation."
+
+# Once the first word is known, only that command's family is described
+COMMAND_FAMILY_HINTS = {
+    "git": "status add commit push pull fetch checkout switch branch log diff stash rebase merge reset",
+    "docker": "run ps exec build images logs pull push stop rm compose",
+    "kubectl": "get describe apply delete logs exec port-forward rollout",
+    "npm": "install run test start init ci publish",
+    "npx": "create-react-app tsc eslint prettier",
+    "pip": "install uninstall freeze list show",
+    "pip3": "install uninstall freeze list show",
+    "conda": "create activate install list env",
+    "cargo": "build run test check add fmt clippy",
+    "systemctl": "status start stop restart enable disable",
+    "apt": "install remove update upgrade search",
+    "apt-get": "install remove update upgrade",
+    "tar": "-xzf -czf -tvf",
+    "ssh": "user@host -i -p -L",
+}
+
+
+@lru_cache(maxsize=256)
+def suggestion_template(first_word: str):
+    """Return (template name, system message) for the command being typed; built once per word"""
+    if not first_word:
+        return "generic", {"role": "system", "content": SUGGESTION_PROMPT}
+    hint = COMMAND_FAMILY_HINTS.get(first_word)
+    if hint:
+        content = f"{SUGGESTION_PROMPT} The command is `{first_word}` (common: {hint})."
+        return f"family:{first_word}", {"role": "system", "content": content}
+    return "command", {"role": "system", "content": f"{SUGGESTION_PROMPT} The command is `{first_word}`."}
+
+def estimate_tokens(text: str) -> int:
+    """Rough token count (~4 characters per token) when the API reports no usage"""
+    return max(1, len(text) // 4) if text else 0
+
+
+class TokenMeter:
+    """Per-template prompt/completion token and latency totals for suggestion calls"""
+
+    def __init__(self):
+        self.templates = {}
+        self._lock = threading.Lock()
+
+    def record(self, template: str, prompt_tokens: int, completion_tokens: int,
+               latency: float, first_token: Optional[float], estimated: bool):
+        with self._lock:
+            entry = self.templates.setdefault(template, {
+                "calls": 0, "prompt_tokens": 0, "completion_tokens": 0,
+                "latency": 0.0, "first_token": 0.0, "first_token_calls": 0, "estimated": 0,
+            })
+            entry["calls"] += 1
+            entry["prompt_tokens"] += prompt_tokens
+            entry["completion_tokens"] += completion_tokens
+            entry["latency"] += latency
+            if first_token is not None:
+                entry["first_token"] += first_token
+                entry["first_token_calls"] += 1
+            entry["estimated"] += estimated
+
+    def stats(self) -> Dict:
+        with self._lock:
+            report = {}
+            for template, entry in self.templates.items():
+                calls = entry["calls"]
+                report[template] = {
+                    "calls": calls,
+                    "prompt_tokens": entry["prompt_tokens"] / calls,
+                    "completion_tokens": entry["completion_tokens"] / calls,
+                    "latency": entry["latency"] / calls,
+                    "first_token": (entry["first_token"] / entry["first_token_calls"]
+                                    if entry["first_token_calls"] else 0.0),
+                    "estimated": entry["estimated"],
+                }
+            return report
+
+
+token_meter = TokenMeter()
+
+async def _stream_suggestion(user_input, model, on_partial=None, call_type="suggestion") -> List[str]:
+    """Stream SUGGESTION_CANDIDATES completions for user_input from one model"""
+    words = user_input.split(maxsplit=1)
+    # The first word is only settled once something follows it
+    first_word = words[0] if len(words) > 1 or user_input.endswith(" ") else ""
+    template, system_message = suggestion_template(first_word)
+    messages = [system_message, {"role": "user", "content": user_input}]
+
+    started = time.monotonic()
+    first_token = None
+    usage = None
+    completion = await llm.acreate(
+        call_type,
+        model=model,
+        messages=messages,
+        max_tokens=50,
+        n=SUGGESTION_CANDIDATES,
+        temperature=0.1 if SUGGESTION_CANDIDATES == 1 else 0.6,
+        stream=True,
+        stream_options={"include_usage": True}
+    )
+
+    texts = {}  # choice index -> streamed text
+    finished = set()
+    async with completion:
+        async for chunk in completion:
+            if getattr(chunk, "usage", None):
+                usage = chunk.usage
+            for choice in chunk.choices or ():
+                if choice.index in finished or not choice.delta.content:
+                    continue
+                if first_token is None:
+                    first_token = time.monotonic() - started
+                texts[choice.index] = texts.get(choice.index, "") + choice.delta.content
+                head = texts[choice.index].lstrip()
+                if "\n" in head or "#" in head:
+                    finished.add(choice.index)
+                # Don't show a partial that is still catching up with what was typed
+                elif (choice.index == 0 and on_partial and STREAM_SUGGESTIONS
+                      and head and not user_input.startswith(head)):
+                    on_partial(_clean_suggestion(user_input, head))
+            # Providers that ignore ``n`` only ever stream choice 0
+            if texts and finished.issuperset(texts):
+                break
+
+    # Stopping early skips the final usage chunk, so fall back to an estimate
+    if usage:
+        prompt_tokens, completion_tokens = usage.prompt_tokens, usage.completion_tokens
+    else:
+        prompt_tokens = sum(estimate_tokens(m["content"]) for m in messages)
+        completion_tokens = sum(estimate_tokens(t) for t in texts.values())
+    token_meter.record(template, prompt_tokens, completion_tokens,
+                       time.monotonic() - started, first_token, estimated=usage is None)
+
+    candidates = []
+    for index in sorted(texts):
+        candidate = _clean_suggestion(user_input, texts[index])
+        if candidate and candidate not in candidates:
+            candidates.append(candidate)
+    return candidates
+
+async def get_ai_suggestion(user_input, on_partial=None, call_type="suggestion"):
+    """Get command completion suggestions from the AI model.
+
+    Runs on prompt_toolkit's event loop; cancelling the awaiting task closes
+    the HTTP stream. With STREAM_SUGGESTIONS enabled, ``on_partial``
+    receives the cleaned suggestion after every chunk. Streaming stops at the
+    first newline or ``#`` since everything after it is discarded anyway.
+
+    SUGGESTION_CANDIDATES alternatives are requested in the same call and
+    all of them are cached for the prefix; the best one is returned. The
+    request is hedged across models, and only the model that streams first
+    gets to show partials.
+    """
+    try:
+        if len(user_input.strip()) < 3:
+            return ""
+
+        # Earlier sessions may already have answered this prefix; SQLite stays off the event loop
+        loop = asyncio.get_running_loop()
+        for model in hedger.models:
+            stored = await loop.run_in_executor(None, disk_cache.lookup_prefix, "suggestion", user_input, model)
+            if stored:
+                suggestion_cache.put(user_input, stored)
+                return stored[0]
+
+        if not api_state.usable():
+            return ""
+
+        leader = []
+
+        async def attempt(model):
+            def partial(text):
+                if not leader:
+                    leader.append(model)
+                if on_partial and leader[0] == model:
+                    on_partial(text)
+            candidates = await _stream_suggestion(user_input, model, on_partial=partial, call_type=call_type)
+            return (model, candidates) if candidates else None
+
+        # print(f"Requesting suggestion for: {user_input}")  # Debug print
+        # A prefetch has paid for one request only, so it is neither hedged nor failed over
+        result = await hedger.arun(attempt, hedge=call_type != "prefetch")
+        if not result:
+            # Failures are counted by llm and shown by !stats, never printed over the prompt
+            return ""
+        model, candidates = result
+        
+        # print(f"Got suggestion: {suggestion}")  # Debug print
+        speculative = user_input if call_type == "prefetch" else None
+        suggestion_cache.put(user_input, candidates, speculative=speculative)
+        loop.run_in_executor(None, disk_cache.put, "suggestion", user_input, "\n".join(candidates), model)
+        return candidates[0]
+        
+    except asyncio.CancelledError:
+        raise
+    except Exception as e:
+        llm.last_error = e
+        return ""
+
+def get_shell_command(query):
+    """Convert natural language query to shell command"""
+    cache_key = " ".join(query.lower().split())
+    for model in hedger.models:
+        cached = disk_cache.get("command", cache_key, model)
+        if cached:
+            print(f"Generated command: {cached} (cached)")
+            return cached
+
+    def attempt(model, cancelled):
+        # Streamed only so that a losing model can be cut off mid-response
+        completion = llm.create(
+            "translate",
+            cancelled=cancelled,
+            model=model,
+            messages=[
+                {
+                    "role": "system", 
+                    "content": """You are a command-line expert. Convert natural language queries into appropriate shell commands.
+                    For file operations, prefer simple commands like touch, echo, mkdir, etc.
+                    Respond ONLY with the command, no explanations or additional text."""
+                },
+                {
+                    "role": "user", 
+                    "content": f"Convert this to a shell command: {query}"
+                }
+            ],
+            max_tokens=50,
+            temperature=0.1,
+            stream=True
+        )
+        text = ""
+        with completion:
+            for chunk in completion:
+                if cancelled.is_set():
+                    return None
+                if chunk.choices and chunk.choices[0].delta.content:
+                    text += chunk.choices[0].delta.content
+
+        command = text.strip()
+        command = command.split("\n")[0].split("#")[0].strip().strip('"').strip("'")
+        return (model, command) if command else None
+
+    try:
+        # print(f"Sending query to AI: {query}")  # Debug print
+        result = hedger.run(attempt)
+        if not result:
+            error = hedger.last_error
+            hedger.last_error = None
+            if error:
+                print(f"Error in get_shell_command: {type(error).__name__}: {str(error)}")
+            else:
+                print("API Response: no command returned")  # Debug print
+            return None
+            
+        model, command = result
+        print(f"Generated command: {command}")  # Debug print
+        disk_cache.put("command", cache_key, command, model)
+        return command
+        
+    except Exception as e:
+        print(f"Error in get_shell_command: {type(e).__name__}: {str(e)}")
+        return None
+
+class AdaptiveDebouncer:
+    """Trailing-edge debounce delay that adapts to typing cadence and model latency.
+
+    The delay sits a little above the user's typical gap between keystrokes,
+    so a fetch fires once they pause rather than mid-word, and grows with the
+    measured model latency because a wasted request costs more on a slow
+    model.
+    """
+
+    MIN_DELAY = 0.08
+    MAX_DELAY = 0.6
+    TYPING_GAP = 1.5  # gaps longer than this are pauses, not typing cadence
+    ALPHA = 0.2  # EWMA smoothing factor
+
+    def __init__(self, initial_delay: float = 0.3):
+        self.typing_interval = initial_delay / 1.3
+        self.model_latency = 0.0
+        self.last_keystroke = 0.0
+        self.keystrokes = 0
+        self.fetches = 0
+
+    def _ewma(self, current: float, sample: float) -> float:
+        return current + self.ALPHA * (sample - current)
+
+    def keystroke(self) -> float:
+        now = time.monotonic()
+        gap = now - self.last_keystroke
+        if self.last_keystroke and gap < self.TYPING_GAP:
+            self.typing_interval = self._ewma(self.typing_interval, gap)
+        self.last_keystroke = now
+        self.keystrokes += 1
+        return now
+
+    def record_latency(self, seconds: float):
+        if self.model_latency:
+            self.model_latency = self._ewma(self.model_latency, seconds)
+        else:
+            self.model_latency = seconds
+
+    def delay(self) -> float:
+        delay = self.typing_interval * 1.3 + self.model_latency * 0.25
+        return min(self.MAX_DELAY, max(self.MIN_DELAY, delay))
+
+    def stats(self) -> Dict:
+        return {
+            "keystrokes": self.keystrokes,
+            "fetches": self.fetches,
+            "suppressed": max(0, self.keystrokes - self.fetches),
+            "delay": self.delay(),
+            "typing_interval": self.typing_interval,
+            "model_latency": self.model_latency,
+        }
+
+
+# Names that are not executables on PATH but are still valid first words
+SHELL_BUILTINS = (
+    "alias", "bg", "cd", "exit", "export", "fg", "history", "jobs", "pwd",
+    "quit", "source", "type", "unalias", "unset", "wait",
+)
+# Words after which the next token is itself a command
+COMMAND_WRAPPERS = ("sudo", "time", "nohup", "env", "exec", "watch", "xargs", "nice")
+
+
+class PathIndex:
+    """Sorted index of executable names on $PATH for first-word completion.
+
+    The index is rebuilt in the background whenever the set of PATH
+    directories or any of their mtimes changes; lookups keep serving the
+    previous index meanwhile and cost one bisect over the sorted names.
+    """
+
+    CHECK_INTERVAL = 2.0  # seconds between PATH mtime checks
+
+    def __init__(self):
+        self.names = []
+        self._signature = None
+        self._checked = 0.0
+        self._building = False
+        self._lock = threading.Lock()
+        self.builds = 0
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _path_signature() -> tuple:
+        signature = []
+        for directory in os.environ.get("PATH", "").split(os.pathsep):
+            try:
+                signature.append((directory, os.stat(directory).st_mtime_ns))
+            except OSError:
+                continue
+        return tuple(signature)
+
+    def build(self, signature: Optional[tuple] = None):
+        signature = signature or self._path_signature()
+        names = set(SHELL_BUILTINS)
+        for directory, _ in signature:
+            try:
+                with os.scandir(directory) as entries:
+                    for entry in entries:
+                        try:
+                            if entry.is_file() and os.access(entry.path, os.X_OK):
+                                names.add(entry.name)
+                        except OSError:
+                            continue
+            except OSError:
+                continue
+        with self._lock:
+            self.names = sorted(names)
+            self._signature = signature
+            self._building = False
+            self.builds += 1
+
+    def _refresh_if_stale(self):
+        now = time.monotonic()
+        if now - self._checked < self.CHECK_INTERVAL:
+            return
+        self._checked = now
+        signature = self._path_signature()
+        with self._lock:
+            if signature == self._signature or self._building:
+                return
+            self._building = True
+        threading.Thread(target=self.build, args=(signature,), daemon=True).start()
+
+    def complete(self, prefix: str, limit: int = 8) -> List[str]:
+        """Executables starting with prefix, shortest first"""
+        self._refresh_if_stale()
+        names = self.names
+        start = bisect.bisect_left(names, prefix)
+        end = bisect.bisect_left(names, prefix + "\U0010ffff", start)
+        matches = [name for name in names[start:end] if name != prefix]
+        if matches:
+            self.hits += 1
+        else:
+            self.misses += 1
+        return sorted(matches, key=len)[:limit]
+
+    def stats(self) -> Dict:
+        return {"executables": len(self.names), "builds": self.builds, "hits": self.hits, "misses": self.misses}
+
+
+path_index = PathIndex()
+
+# Commands whose arguments are almost always paths
+PATH_COMMANDS = (
+    "cat", "cd", "chmod", "chown", "cp", "diff", "du", "file", "head", "less",
+    "ls", "mkdir", "more", "mv", "nano", "python", "python3", "rm", "rmdir",
+    "source", "stat", "tail", "touch", "vi", "vim", "wc",
+)
+
+
+class DirectoryCache:
+    """LRU cache of directory listings, invalidated by the directory's mtime"""
+
+    def __init__(self, max_dirs: int = 256):
+        self.max_dirs = max_dirs
+        self._entries = OrderedDict()  # path -> (mtime_ns, sorted [(name, is_dir)])
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def listing(self, directory: str) -> List[Tuple[str, bool]]:
+        try:
+            mtime = os.stat(directory).st_mtime_ns
+        except OSError:
+            return []
+        with self._lock:
+            cached = self._entries.get(directory)
+            if cached and cached[0] == mtime:
+                self._entries.move_to_end(directory)
+                self.hits += 1
+                return cached[1]
+            self.misses += 1
+
+        entries = []
+        try:
+            with os.scandir(directory) as scanned:
+                for entry in scanned:
+                    try:
+                        entries.append((entry.name, entry.is_dir()))
+                    except OSError:
+                        continue
+        except OSError:
+            return []
+        entries.sort()
+
+        with self._lock:
+            self._entries[directory] = (mtime, entries)
+            self._entries.move_to_end(directory)
+            while len(self._entries) > self.max_dirs:
+                self._entries.popitem(last=False)
+        return entries
+
+    def complete(self, token: str, limit: int = 8, dirs_only: bool = False) -> List[str]:
+        """Completions of a partial path, directories ending in a slash"""
+        head, _, partial = token.rpartition("/")
+        if token.startswith("/") and not head:
+            head = "/"
+        directory = os.path.expanduser(head) if head else "."
+        # Hidden files only when asked for
+        show_hidden = partial.startswith(".")
+        prefix = token[:len(token) - len(partial)]
+        found = []
+        for name, is_dir in self.listing(directory):
+            if not name.startswith(partial) or (name.startswith(".") and not show_hidden):
+                continue
+            if dirs_only and not is_dir:
+                continue
+            completion = prefix + name + ("/" if is_dir else "")
+            if completion != token:
+                found.append(completion)
+            if len(found) >= limit:
+                break
+        return found
+
+    def stats(self) -> Dict:
+        total = self.hits + self.misses
+        with self._lock:
+            cached = len(self._entries)
+            names = sum(len(entries) for _, entries in self._entries.values())
+        return {
+            "directories": cached,
+            "names": names,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+        }
+
+
+directory_cache = DirectoryCache()
+
+# The last word of a line, with any backslash-escaped spaces in it
+SHELL_WORD_PATTERN = re.compile(r"(?:\\.|[^ \\])*\\?$")
+# Characters of a completed file name that the shell needs escaped
+SHELL_UNSAFE_PATTERN = re.compile(r"[^\w/.,:@%+=~-]")
+
+
+def shell_escape(name: str) -> str:
+    return SHELL_UNSAFE_PATTERN.sub(lambda match: "\\" + match.group(), name)
+
+
+def shell_unescape(word: str) -> str:
+    return re.sub(r"\\(.)", r"\1", word)
+
+
+def path_position(typed_text: str) -> Optional[str]:
+    """The partial path argument being typed, as typed (escapes included), or None if it is not a path"""
+    token = SHELL_WORD_PATTERN.search(typed_text).group()
+    words = typed_text.split(" ")
+    if not typed_text[:len(typed_text) - len(token)].strip() or command_position(typed_text) is not None:
+        return None
+    if token.startswith(("/", "./", "../", "~")) or "/" in token:
+        return token
+    if words[0] in PATH_COMMANDS and not token.startswith("-"):
+        return token
+    return None
+
+
+# Tools whose second word is a subcommand with its own options
+SUBCOMMAND_TOOLS = (
+    "apt", "brew", "cargo", "conda", "docker", "gh", "git", "go", "kubectl",
+    "npm", "pip", "pip3", "poetry", "systemctl", "uv", "yarn",
+)
+# Tools known to print help and exit for the given argument. Only these are ever
+# executed by the flag index; anything else is looked up in its man page alone,
+# since an unknown program (a user's own script, say) may ignore the argument
+# and do its real work instead.
+HELP_ARGUMENTS = {
+    "git": "-h",  # "git <sub> --help" opens the man page through a pager
+    **{tool: "--help" for tool in (
+        "apt", "awk", "brew", "cargo", "cat", "chmod", "chown", "conda", "cp", "curl",
+        "cut", "date", "df", "diff", "docker", "du", "find", "gh", "go", "grep", "gzip",
+        "head", "kubectl", "less", "ln", "ls", "make", "mkdir", "mv", "node", "npm",
+        "pip", "pip3", "poetry", "ps", "python", "python3", "rm", "rsync", "sed", "sort",
+        "ssh", "systemctl", "tail", "tar", "touch", "uniq", "unzip", "uv", "wc", "wget",
+        "xargs", "yarn", "zip",
+    )},
+}
+# Subcommands built into each tool. Any other name may reach an external
+# program (git-<name>, a "!" alias, a cargo/kubectl/docker/gh plugin, a yarn
+# script), so only these are run with the help argument; the rest get man only.
+BUILTIN_SUBCOMMANDS = {tool: frozenset(names.split()) for tool, names in {
+    "apt": "install remove purge update upgrade full-upgrade autoremove search show list edit-sources",
+    "brew": "install uninstall upgrade update list search info outdated cleanup doctor services tap untap",
+    "cargo": "add bench build check clean doc fetch fix init install metadata new publish remove run "
+             "search test tree uninstall update",
+    "conda": "activate clean config create deactivate env info install list remove search update",
+    "docker": "attach build commit compose container cp create exec image images inspect kill login logout "
+              "logs network ps pull push restart rm rmi run start stats stop system tag top volume",
+    "gh": "api auth browse gist issue pr release repo run secret workflow",
+    "git": "add am apply bisect blame branch checkout cherry-pick clean clone commit config describe diff "
+           "fetch grep init log merge mv pull push rebase reflog remote reset restore revert rm show "
+           "stash status submodule switch tag worktree",
+    "go": "build clean doc env fmt generate get install list mod run test tool vet work",
+    "kubectl": "annotate apply attach config cp create delete describe edit exec explain expose get label "
+               "logs patch port-forward rollout run scale set top",
+    "npm": "audit cache ci config exec init install link list ls outdated pack publish rebuild run "
+           "search test uninstall update view",
+    "pip": "cache check config download freeze hash index inspect install list search show uninstall wheel",
+    "poetry": "add build check config env export init install lock new publish remove run show update",
+    "systemctl": "cat daemon-reload disable enable is-active is-enabled kill list-units list-unit-files "
+                 "mask reload restart show start status stop unmask",
+    "uv": "add build cache export init lock pip publish python remove run sync tool tree venv",
+    "yarn": "add audit cache config info init install link list outdated remove upgrade why",
+}.items()}
+BUILTIN_SUBCOMMANDS["pip3"] = BUILTIN_SUBCOMMANDS["pip"]
+FLAG_PATTERN = re.compile(r"(?:^|[\s,/\[|])(--?[A-Za-z0-9][A-Za-z0-9_-]*)")
+OVERSTRIKE_PATTERN = re.compile(r".\x08")
+
+
+class FlagIndex:
+    """Options of installed commands, parsed from man pages and, for known tools, ``--help``.
+
+    Parsing runs on a single background thread. Results are persisted in
+    the disk cache keyed by executable path and mtime, so an upgraded
+    binary is re-parsed while an unchanged one is loaded straight from disk.
+    """
+
+    RECHECK_INTERVAL = 300.0  # seconds before an indexed command's mtime is checked again
+    HELP_TIMEOUT = 3.0
+
+    def __init__(self):
+        self._flags = {}  # "git log" -> (flags, indexed_at)
+        self._pending = set()
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._worker = None
+        self.parsed = 0
+        self.loaded = 0
+        self.failed = 0
+        self.hits = 0
+        self.misses = 0
+
+    def _schedule(self, command: str):
+        with self._lock:
+            if command in self._pending:
+                return
+            self._pending.add(command)
+            if self._worker is None:
+                self._worker = threading.Thread(target=self._run, daemon=True)
+                self._worker.start()
+        self._queue.put(command)
+
+    def _run(self):
+        while True:
+            command = self._queue.get()
+            try:
+                flags = self.index(command)
+            except Exception:
+                flags = ()
+            with self._lock:
+                self._flags[command] = (flags, time.monotonic())
+                self._pending.discard(command)
+
+    def _help_text(self, argv: List[str], man_page: str, help_arg: Optional[str]) -> str:
+        env = dict(os.environ, LC_ALL="C", MANPAGER="cat", PAGER="cat", GIT_PAGER="cat")
+        attempts = [["man", man_page]]
+        if help_arg:
+            attempts.insert(0, argv + [help_arg])
+        for attempt in attempts:
+            try:
+                result = subprocess.run(attempt, capture_output=True, text=True, errors="replace",
+                                        stdin=subprocess.DEVNULL, env=env, timeout=self.HELP_TIMEOUT)
+            except (OSError, subprocess.SubprocessError):
+                continue
+            text = OVERSTRIKE_PATTERN.sub("", result.stdout + result.stderr)
+            if sum(line.lstrip().startswith("-") for line in text.splitlines()) >= 3:
+                return text
+        return ""
+
+    @staticmethod
+    def parse(text: str) -> Tuple[str, ...]:
+        """Options from the lines of a help text that document them"""
+        flags = []
+        for line in text.splitlines():
+            stripped = line.lstrip()
+            if stripped.startswith("-"):
+                flags.extend(FLAG_PATTERN.findall(stripped))
+        return tuple(dict.fromkeys(flag for flag in flags if flag not in ("-", "--")))
+
+    def index(self, command: str) -> Tuple[str, ...]:
+        """Flags of ``command`` (an executable, optionally followed by a subcommand)"""
+        words = command.split(" ")
+        executable = shutil.which(words[0])
+        if not executable:
+            self.failed += 1
+            return ()
+        try:
+            mtime = os.stat(executable).st_mtime_ns
+        except OSError:
+            self.failed += 1
+            return ()
+
+        key = f"{executable} {' '.join(words[1:])}".strip() + f"@{mtime}"
+        stored = disk_cache.get("flags", key, model="local")
+        if stored is not None:
+            self.loaded += 1
+            return tuple(stored.split("\n")) if stored else ()
+
+        flags = self.parse(self._help_text([executable] + words[1:], "-".join(words), help_argument(command)))
+        if flags:
+            self.parsed += 1
+        else:
+            self.failed += 1
+        # Empty results are stored too so unhelpful binaries are not re-run
+        disk_cache.put("flags", key, "\n".join(flags), model="local", keep_empty=True)
+        return flags
+
+    def flags(self, command: str) -> Optional[Tuple[str, ...]]:
+        """Known flags of command, or None while it is still being indexed"""
+        with self._lock:
+            entry = self._flags.get(command)
+        if entry is None or time.monotonic() - entry[1] > self.RECHECK_INTERVAL:
+            self._schedule(command)
+        return entry[0] if entry else None
+
+    def complete(self, command: str, token: str, used: List[str], limit: int = 8) -> List[str]:
+        flags = self.flags(command)
+        matches = [flag for flag in flags or () if flag.startswith(token) and flag != token and flag not in used]
+        if matches:
+            self.hits += 1
+        else:
+            self.misses += 1
+        return sorted(matches, key=len)[:limit]
+
+    def index_frequent(self, commands: List[str], limit: int = 20):
+        """Queue the most used known tools in history so their flags are ready before they are typed"""
+        counts = {}
+        for line in commands:
+            command = flag_command(line.split(" ") + [""])
+            if command and help_argument(command):
+                counts[command] = counts.get(command, 0) + 1
+        for command in sorted(counts, key=counts.get, reverse=True)[:limit]:
+            self._schedule(command)
+
+    def stats(self) -> Dict:
+        total = self.hits + self.misses
+        return {
+            "commands": len(self._flags),
+            "parsed": self.parsed,
+            "loaded": self.loaded,
+            "failed": self.failed,
+            "hits": self.hits,
+            "hit_rate": self.hits / total if total else 0.0,
+        }
+
+
+flag_index = FlagIndex()
+
+def help_argument(command: str) -> Optional[str]:
+    """The argument that makes command print its help, or None when it must not be run"""
+    tool, _, subcommand = command.partition(" ")
+    if subcommand and subcommand not in BUILTIN_SUBCOMMANDS.get(tool, ()):
+        return None
+    return HELP_ARGUMENTS.get(tool)
+
+
+def flag_command(words: List[str]) -> Optional[str]:
+    """The command whose options apply to these words: the executable, plus its subcommand if it has them"""
+    while len(words) > 1 and words[0] in COMMAND_WRAPPERS:
+        words = words[1:]
+    if not words or not re.fullmatch(r"[\w.+-]+", words[0]):
+        return None
+    if (words[0] in SUBCOMMAND_TOOLS and len(words) > 2
+            and re.fullmatch(r"[a-z][a-z0-9-]*", words[1])):
+        return f"{words[0]} {words[1]}"
+    return words[0]
+
+
+def flag_position(typed_text: str) -> Optional[Tuple[str, str]]:
+    """(command, partial flag) when an option is being typed"""
+    words = typed_text.split(" ")
+    if len(words) < 2 or not words[-1].startswith("-"):
+        return None
+    command = flag_command(words)
+    return (command, words[-1]) if command else None
+
+
+def command_position(typed_text: str) -> Optional[str]:
+    """The partial command name being typed, or None when the cursor is in the arguments"""
+    words = typed_text.split(" ")
+    while len(words) > 1 and words[0] in COMMAND_WRAPPERS:
+        words = words[1:]
+    if len(words) == 1 and words[0]:
+        return words[0]
+    return None
+
+
+def structural_candidates(typed_text: str) -> Tuple[Optional[str], List[str]]:
+    """Candidates that follow from the shape of the line: ("command" | "path" | "flag" | None, lines)"""
+    # The command name itself comes from $PATH
+    command = command_position(typed_text)
+    if command is not None:
+        return "command", [typed_text + name[len(command):] for name in path_index.complete(command)]
+
+    # Paths come from the filesystem, which the model cannot see
+    token = path_position(typed_text)
+    if token is not None:
+        stem = typed_text[:len(typed_text) - len(token)]
+        dirs_only = typed_text.split(" ", 1)[0] in ("cd", "rmdir")
+        # Look the name up unescaped, and escape only what the completion adds
+        partial = shell_unescape(token)
+        return "path", [stem + token + shell_escape(path[len(partial):])
+                        for path in directory_cache.complete(partial, dirs_only=dirs_only)]
+
+    # Options come from the command's own documentation when it has been indexed
+    option = flag_position(typed_text)
+    if option is not None:
+        command, token = option
+        stem = typed_text[:len(typed_text) - len(token)]
+        return "flag", [stem + flag for flag in flag_index.complete(command, token, typed_text.split(" "))]
+    return None, []
+
+
+class SpeculativePrefetcher:
+    """Fills the suggestion cache for the likely next words while the user pauses.
+
+    Guesses come from the history trie's ranking of the words that followed
+    the typed text before, topped up with the command family hints. At most
+    one prefetch request runs at a time and a token bucket caps the overall
+    request budget; typing something the current run cannot help with
+    cancels it.
+    """
+
+    IDLE_DELAY = 0.4  # wait this long into a pause before speculating
+    MAX_GUESSES = 3
+
+    def __init__(self, rate: float = 1 / 20, burst: float = 6.0):
+        self.bucket = TokenBucket(rate, burst)
+        self._task = None
+        self._base = None
+        self.requests = 0
+        self.skipped = 0
+        self.cancelled = 0
+
+    def guesses(self, text: str) -> List[str]:
+        tokens = command_trie.next_tokens(text, self.MAX_GUESSES)
+        words = text.split()
+        if len(words) == 1 and text.endswith(" "):
+            tokens += [t for t in COMMAND_FAMILY_HINTS.get(words[0], "").split() if t not in tokens]
+        return [text + token for token in tokens[:self.MAX_GUESSES]]
+
+    def schedule(self, text: str):
+        if not text.endswith(" ") or text.startswith("?"):
+            return
+        self.cancel()
+        self._base = text
+        self._task = asyncio.ensure_future(self._run(text))
+
+    def on_text_changed(self, text: str):
+        # A run for "docker " stays useful while the user types "docker r"
+        if self._base is not None and not text.startswith(self._base):
+            self.cancel()
+
+    def cancel(self):
+        if self._task and not self._task.done():
+            self._task.cancel()
+            self.cancelled += 1
+        self._task = None
+        self._base = None
+
+    async def _run(self, text: str):
+        await asyncio.sleep(self.IDLE_DELAY)
+        for prefix in self.guesses(text):
+            if command_trie.lookup(prefix, count=False) or suggestion_cache.lookup(prefix, count=False):
+                self.skipped += 1
+                continue
+            if not self.bucket.try_acquire():
+                return
+            self.requests += 1
+            await get_ai_suggestion(prefix, call_type="prefetch")
+
+            # Also file the answer under the partial words in between, so "docker r" hits too
+            candidates = suggestion_cache.candidates(prefix, count=False)
+            for end in range(len(text) + 1, len(prefix)):
+                partial = prefix[:end]
+                if candidates and not suggestion_cache.lookup(partial, count=False):
+                    suggestion_cache.put(partial, candidates, speculative=prefix)
+
+    def stats(self) -> Dict:
+        hits = suggestion_cache.speculative_hits
+        return {
+            "requests": self.requests,
+            "skipped": self.skipped,
+            "cancelled": self.cancelled,
+            "hits": hits,
+            "hit_rate": hits / self.requests if self.requests else 0.0,
+        }
+
+
+prefetcher = SpeculativePrefetcher()
+
+class RedrawLimiter:
+    """Coalesces UI invalidations into at most MAX_FRAME_RATE redraws per second.
+
+    prompt_toolkit already folds invalidations that arrive before the next
+    redraw into one; ``min_redraw_interval`` adds the frame-rate cap, and it
+    postpones rather than drops a redraw so the last update always lands.
+    Keystrokes, streamed partials and completion results all go through it.
+    """
+
+    def __init__(self):
+        self._app = None
+        self.requests = 0
+        self.coalesced = 0
+        self.invalidations = 0
+        self.frames = 0
+
+    def attach(self, app):
+        self._app = app
+        app.min_redraw_interval = 1.0 / MAX_FRAME_RATE if MAX_FRAME_RATE else None
+        app.on_invalidate += self._on_invalidate
+        app.after_render += self._on_render
+
+    def _on_invalidate(self, _app):
+        self.invalidations += 1
+
+    def _on_render(self, _app):
+        self.frames += 1
+
+    def request(self):
+        """Thread-safe redraw request"""
+        app = self._app or get_app()
+        self.requests += 1
+        if app.invalidated:
+            self.coalesced += 1
+            return
+        app.invalidate()
+
+    def stats(self) -> Dict:
+        return {
+            "requests": self.requests,
+            "coalesced": self.coalesced,
+            "invalidations": self.invalidations,
+            "frames": self.frames,
+            "max_fps": MAX_FRAME_RATE,
+        }
+
+
+redraw_limiter = RedrawLimiter()
+
+
+class AIAutoSuggest(AutoSuggest):
+    """Custom AutoSuggest class for AI-powered command completion.
+
+    ``get_suggestion`` answers from local sources only: the history trie and
+    cached AI candidates, looked up in the default executor since PATH and
+    directory candidates touch the filesystem. ``get_suggestion_async`` runs on prompt_toolkit's
+    event loop; prompt_toolkit runs it one at a time and retries it with the
+    latest text, so a trailing-edge debounce is just a sleep until typing
+    has paused. The fetch itself is an asyncio task that ``cancel_inflight``
+    cancels as soon as the text changes, closing its HTTP stream.
+
+    All known candidates for the typed text are kept in order and ``cycle``
+    moves between them without another request. ``settled`` lets the
+    completer wait for whatever auto-suggest does with a text.
+    """
+    def __init__(self):
+        self.offset = 0
+        self.debouncer = AdaptiveDebouncer()
+        self._inflight = None
+        self._waiters = {}  # typed text -> future set once auto-suggest is done with it
+        self._answered = None
+        self.cancelled = 0
+
+    def reset_cycle(self):
+        self.offset = 0
+
+    def cycle(self, step: int = 1):
+        self.offset += step
+
+    def on_text_changed(self, buffer):
+        self.reset_cycle()
+        self.debouncer.keystroke()
+        self.cancel_inflight()
+        self._answered = None
+        self._settle(lambda text: text != buffer.text)
+        prefetcher.on_text_changed(buffer.text)
+
+    def settled(self, typed_text: str) -> asyncio.Future:
+        """Future that is done once auto-suggest has answered typed_text.
+
+        The answer may come from local sources, the cache or a request; either
+        way it is in the suggestion cache by then. Already done when the text
+        has been answered, and done early if the text changes first.
+        """
+        waiter = asyncio.get_running_loop().create_future()
+        if typed_text == self._answered:
+            waiter.set_result(None)
+            return waiter
+        return self._waiters.setdefault(typed_text, waiter)
+
+    def _settle(self, matches):
+        for text in [text for text in self._waiters if matches(text)]:
+            waiter = self._waiters.pop(text)
+            if not waiter.done():
+                waiter.set_result(None)
+
+    def cancel_inflight(self):
+        if self._inflight and not self._inflight.done():
+            self._inflight.cancel()
+            self.cancelled += 1
+
+    def candidates(self, typed_text: str) -> List[str]:
+        found = []
+
+        # Commands run before are answered locally, before any cached AI result
+        remembered = command_trie.lookup(typed_text)
+        if remembered:
+            found.append(remembered)
+
+        # Command names and paths never come from the model
+        kind, structural = structural_candidates(typed_text)
+        found.extend(structural)
+        if kind in ("command", "path"):
+            return list(dict.fromkeys(found))
+
+        found.extend(suggestion_cache.candidates(typed_text))
+        return list(dict.fromkeys(found))
+
+    def get_suggestion(self, _buffer, document):
+        typed_text = document.text
+        if not typed_text.strip():
+            return None
+
+        found = self.candidates(typed_text)
+        if not found:
+            return None
+        suggestion = found[self.offset % len(found)]
+        return Suggestion(suggestion[len(typed_text):])
+
+    def _show_partial(self, buffer, typed_text: str, suggestion: str):
+        if buffer.text != typed_text or not suggestion.startswith(typed_text):
+            return
+        buffer.suggestion = Suggestion(suggestion[len(typed_text):])
+
+        redraw_limiter.request()
+
+    async def get_suggestion_async(self, buffer, document):
+        try:
+            return await self._suggest(buffer, document)
+        finally:
+            if buffer.document == document:
+                self._answered = document.text
+            self._settle(lambda text: text == document.text)
+
+    async def _suggest(self, buffer, document):
+        # The local sources stat the filesystem, so they run in the default executor
+        local = await asyncio.get_running_loop().run_in_executor(None, self.get_suggestion, buffer, document)
+        typed_text = document.text
+        if (local or typed_text.startswith("?") or len(typed_text.strip()) < 2
+                or command_position(typed_text) is not None
+                or path_position(typed_text) is not None):
+            prefetcher.schedule(typed_text)
+            return local
+
+        # Trailing edge: wait until typing has paused for the adaptive delay
+        while True:
+            remaining = self.debouncer.last_keystroke + self.debouncer.delay() - time.monotonic()
+            if remaining <= 0:
+                break
+            await asyncio.sleep(remaining)
+        if buffer.document != document:
+            return None
+
+        self.debouncer.fetches += 1
+        started = time.monotonic()
+        self._inflight = asyncio.ensure_future(get_ai_suggestion(
+            typed_text,
+            on_partial=lambda partial: self._show_partial(buffer, typed_text, partial),
+        ))
+        try:
+            suggestion = await self._inflight
+        except asyncio.CancelledError:
+            return None
+        finally:
+            self._inflight = None
+        self.debouncer.record_latency(time.monotonic() - started)
+        prefetcher.schedule(typed_text)
+
+        if suggestion and suggestion.startswith(typed_text) and suggestion != typed_text:
+            return Suggestion(suggestion[len(typed_text):])
+        return None
+
+    def stats(self) -> Dict:
+        return {"fetched": self.debouncer.fetches, "cancelled": self.cancelled}
+
+
+# Seconds each completion source may take, measured from the keystroke;
+# a source that misses its budget is left out of that menu
+COMPLETION_BUDGETS = {"history": 0.05, "local": 0.1, "ai": 1.5}
+
+
+class ShellCompleter(Completer):
+    """Dropdown of whole-line completions merged from every source.
+
+    Sources start together and are merged in rank order: history, then
+    PATH/path/flag candidates, then AI. Local sources run in the default
+    executor so a slow filesystem cannot stall the prompt. The AI source
+    never starts a request of its own; it waits for the auto-suggest fetch
+    for the same text, so results stream into the open menu when they land.
+    """
+
+    def __init__(self, auto_suggest: AIAutoSuggest):
+        self.auto_suggest = auto_suggest
+        self.served = {name: 0 for name in COMPLETION_BUDGETS}
+        self.late = {name: 0 for name in COMPLETION_BUDGETS}
+        self.latency = {name: 0.0 for name in COMPLETION_BUDGETS}
+
+    @staticmethod
+    def _history(typed_text: str) -> List[str]:
+        return command_trie.ranked(typed_text)
+
+    @staticmethod
+    def _local(typed_text: str) -> List[Tuple[str, str]]:
+        kind, found = structural_candidates(typed_text)
+        return [(candidate, kind) for candidate in found]
+
+    async def _ai(self, typed_text: str) -> List[str]:
+        if command_position(typed_text) is not None or path_position(typed_text) is not None:
+            return []
+        cached = suggestion_cache.candidates(typed_text, count=False)
+        if not cached:
+            # Done as soon as auto-suggest answers locally, or once its request lands
+            await asyncio.wait({self.auto_suggest.settled(typed_text)})
+            cached = suggestion_cache.candidates(typed_text, count=False)
+        return cached
+
+    @staticmethod
+    def _completion(typed_text: str, candidate: str, source: str) -> Completion:
+        word_start = typed_text.rfind(" ") + 1
+        return Completion(candidate, start_position=-len(typed_text),
+                          display=candidate[word_start:] or candidate, display_meta=source)
+
+    def _skip(self, document) -> bool:
+        typed_text = document.text
+        return (not typed_text.strip() or document.cursor_position != len(typed_text)
+                or typed_text.startswith(("?", "/", "!")))
+
+    def get_completions(self, document, complete_event):
+        if self._skip(document):
+            return
+        seen = {document.text}
+        for candidate in self._history(document.text):
+            if candidate not in seen:
+                seen.add(candidate)
+                yield self._completion(document.text, candidate, "history")
+        for candidate, kind in self._local(document.text):
+            if candidate not in seen:
+                seen.add(candidate)
+                yield self._completion(document.text, candidate, kind)
+
+    async def get_completions_async(self, document, complete_event):
+        if self._skip(document):
+            return
+        typed_text = document.text
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        tasks = [
+            ("history", loop.run_in_executor(None, self._history, typed_text)),
+            ("local", loop.run_in_executor(None, self._local, typed_text)),
+            ("ai", asyncio.ensure_future(self._ai(typed_text))),
+        ]
+        seen = {typed_text}
+        try:
+            for source, task in tasks:
+                remaining = started + COMPLETION_BUDGETS[source] - loop.time()
+                try:
+                    found = await asyncio.wait_for(asyncio.shield(task), max(remaining, 0.0))
+                except asyncio.TimeoutError:
+                    self.late[source] += 1
+                    continue
+                self.served[source] += 1
+                self.latency[source] += loop.time() - started
+                for candidate in found:
+                    # Local candidates carry their kind (command, path or flag) as the label
+                    candidate, label = candidate if isinstance(candidate, tuple) else (candidate, source)
+                    if candidate not in seen:
+                        seen.add(candidate)
+                        yield self._completion(typed_text, candidate, label)
+        finally:
+            for _, task in tasks:
+                task.cancel()
+
+    def stats(self) -> Dict:
+        return {
+            source: {
+                "served": self.served[source],
+                "late": self.late[source],
+                "mean_latency": self.latency[source] / self.served[source] if self.served[source] else 0.0,
+            }
+            for source in COMPLETION_BUDGETS
+        }
+
+
+ai_suggest = None
+shell_completer = None
+
+# Runs each command with eval inside one long-lived bash. Commands arrive
+# NUL-terminated on the fd in $2; after each one the sentinel is written to
+# the terminal, to mark the end of the command's output, and a record with
+# the exit status, new working directory and OLDPWD is written to the fd in $3.
+# The shell starts in a new session and reopens the PTY named in $4 by path,
+# which makes it the controlling terminal so Ctrl+C reaches the command.
+# SIGINT is trapped rather than ignored so children still get the default.
+# The command is eval'd inside a function so the trap can abort the rest of
+# it with status 130, as an interactive bash does (a function the command
+# defines itself is only returned from). The trap is set again before every
+# command because bash skips a trap whose last run ended in a return.
+# Job control signals are ignored because Ctrl+Z would otherwise stop the
+# shell itself (use a trailing & for background work).
+SHELL_LOOP = r"""
+exec 0<>"$4" 1>&0 2>&0
+trap '' TSTP TTIN TTOU
+shopt -s expand_aliases
+__aishell_run() {
+    eval "$__aishell_command"
+}
+while :; do
+    trap '[[ ${FUNCNAME[0]-} ]] && return 130' INT
+    IFS= read -r -d '' __aishell_command <&"$2" || { (( $? > 128 )) && continue; break; }
+    __aishell_run
+    __aishell_status=$?
+    printf '%s\0' "$1"
+    printf '%s %d %s\037%s\0' "$1" "$__aishell_status" "$PWD" "$OLDPWD" >&"$3"
+done
+"""
+CAPTURE_BYTES = 64 * 1024  # output kept per command for error analysis
+
+
+class RingBuffer:
+    """Keeps the last ``capacity`` bytes written to it in one preallocated buffer"""
+
+    def __init__(self, capacity: int = CAPTURE_BYTES):
+        self.capacity = capacity
+        self._data = bytearray(capacity)
+        self._end = 0
+        self.written = 0
+
+    def write(self, chunk: bytes):
+        size = len(chunk)
+        self.written += size
+        if size >= self.capacity:
+            self._data[:] = chunk[-self.capacity:]
+            self._end = 0
+            return
+        first = min(size, self.capacity - self._end)
+        self._data[self._end:self._end + first] = chunk[:first]
+        self._data[:size - first] = chunk[first:]
+        self._end = (self._end + size) % self.capacity
+
+    @property
+    def truncated(self) -> bool:
+        return self.written > self.capacity
+
+    def getvalue(self) -> bytes:
+        if not self.truncated and self.written < self.capacity:
+            return bytes(self._data[:self._end])
+        return bytes(self._data[self._end:] + self._data[:self._end])
+
+    def tail(self) -> str:
+        """Captured text, starting at a line boundary when older output was dropped"""
+        text = self.getvalue().decode(errors="replace")
+        if self.truncated and "\n" in text.rstrip("\n"):
+            text = text.partition("\n")[2]
+        return text
 
-# At the top of your file, add this debug print
-print("Using OpenRouter API key:", os.getenv("deepseek_api")[:8] + "..." if os.getenv("deepseek_api") else "Not found")
 
-FALLBACK_MODEL = "openai/gpt-3.5-turbo:free"
+class ShellSession:
+    """A persistent bash on a pseudo-terminal that keeps cd, export, aliases and venvs between commands.
 
-client = OpenAI(
-    base_url="https://openrouter.ai/api/v1",
-    api_key=os.getenv("deepseek_api"),
-    timeout=5.0,
-    default_headers={
-        "HTTP-Referer": "https://openrouter.ai/",  # Required for OpenRouter
-    }
-)
+    The shell's stdin, stdout and stderr are the PTY, so programs see a real
+    terminal and vim, top, progress bars and colours work. While a command
+    runs, this terminal is put in raw mode; keystrokes are passed to the PTY
+    and output is read into one preallocated buffer, written to stdout from
+    that buffer and teed into a bounded RingBuffer for error analysis.
+    """
 
-# Test the API connection
-def test_api_connection():
-    try:
-        completion = client.chat.completions.create(
-            model=FALLBACK_MODEL,
-            messages=[
-                {"role": "system", "content": "You are a helpful assistant."},
-                {"role": "user", "content": "Say 'API connection successful'"}
-            ],
-            max_tokens=10
-        )
-        print("API Test Response:", completion.choices[0].message.content if completion.choices else "No response")
-        return True
-    except Exception as e:
-        print("API Test Error:", str(e))
+    READ_SIZE = 64 * 1024
+    MARKER_GRACE = 0.2  # seconds to wait for the end marker once the status is in
+
+    def __init__(self):
+        self.process = None
+        self._commands = None
+        self._status = None
+        self._master = None
+        self._sentinel = f"__AISHELL_DONE_{os.getpid()}_{random.getrandbits(32):08x}__"
+        self._pending_sync = []
+        self._marker = (self._sentinel + "\0").encode()
+        self._held = b""
+        self._buffer = bytearray(self.READ_SIZE)
+        self.capture = RingBuffer()
+        self.started = 0
+        self.commands = 0
+        self.captured_bytes = 0
+
+    @staticmethod
+    def available() -> bool:
+        return PTY_AVAILABLE and shutil.which("bash") is not None
+
+    @staticmethod
+    def _copy_window_size(target: int):
+        try:
+            size = fcntl.ioctl(sys.stdout.fileno(), termios.TIOCGWINSZ, b"\0" * 8)
+            fcntl.ioctl(target, termios.TIOCSWINSZ, size)
+        except OSError:
+            pass
+
+    def start(self):
+        master, slave = os.openpty()
+        if os.isatty(0):
+            try:
+                termios.tcsetattr(slave, termios.TCSANOW, termios.tcgetattr(0))
+            except termios.error:
+                pass
+        self._copy_window_size(slave)
+        command_read, command_write = os.pipe()
+        status_read, status_write = os.pipe()
+        try:
+            self.process = subprocess.Popen(
+                ["bash", "--noprofile", "--norc", "-c", SHELL_LOOP, "aishell",
+                 self._sentinel, str(command_read), str(status_write), os.ttyname(slave)],
+                stdin=slave, stdout=slave, stderr=slave,
+                pass_fds=(command_read, status_write),
+                start_new_session=True,
+            )
+        finally:
+            os.close(command_read)
+            os.close(status_write)
+            os.close(slave)
+        self._commands = os.fdopen(command_write, "wb", buffering=0)
+        self._status = status_read
+        self._master = master
+        self._held = b""
+        self.started += 1
+
+    def close(self):
+        if self.process is None:
+            return
+        try:
+            self._commands.close()
+            self.process.wait(timeout=1)
+        except (OSError, subprocess.TimeoutExpired):
+            self.process.kill()
+        os.close(self._status)
+        os.close(self._master)
+        self.process = None
+
+    def resize(self):
+        if self._master is not None:
+            self._copy_window_size(self._master)
+
+    def sync(self, statement: str):
+        """Queue a statement that mirrors an in-process builtin, sent ahead of the next command"""
+        self._pending_sync.append(statement)
+
+    def run(self, command: str) -> int:
+        """Run command in the session and return its exit status"""
+        if self.process is None or self.process.poll() is not None:
+            self.start()
+            # A fresh shell inherits this process's directory and environment already
+            self._pending_sync.clear()
+        while self._pending_sync:
+            self._send(self._pending_sync.pop(0))
+        self.commands += 1
+        return self._send(command)
+
+    def snapshot(self, path: str) -> bool:
+        """Write the session's exported variables and aliases to path as shell source; builtins only, no fork"""
+        if self.process is None or self.process.poll() is not None:
+            # No session yet: it would start from this process's environment anyway
+            return False
+        while self._pending_sync:
+            self._send(self._pending_sync.pop(0))
+        return self._send(f"{{ export -p; alias -p; }} >{shlex.quote(path)}") == 0
+
+    def _forward(self, view: memoryview):
+        if not view:
+            return
+        self.capture.write(view)
+        self.captured_bytes += len(view)
+        while view:
+            try:
+                view = view[os.write(1, view):]
+            except OSError:
+                return
+
+    def _scan(self, data, end: int) -> bool:
+        """Forward data[:end] minus the end marker; True once the marker has been seen"""
+        marker = self._marker
+        view = memoryview(data)
+        index = data.find(marker, 0, end)
+        if index >= 0:
+            self._held = b""
+            self._forward(view[:index])
+            self._forward(view[index + len(marker):end])
+            return True
+        # Hold back only a tail that could be the start of a marker split across reads
+        keep = 0
+        start = data.find(marker[:1], max(0, end - len(marker) + 1), end)
+        while start >= 0:
+            if marker.startswith(data[start:end]):
+                keep = end - start
+                break
+            start = data.find(marker[:1], start + 1, end)
+        self._forward(view[:end - keep])
+        self._held = bytes(view[end - keep:end])
         return False
 
-# Call this at startup
-if test_api_connection():
-    print("OpenRouter API connection successful")
-else:
-    print("OpenRouter API connection failed")
+    def _pump(self) -> Optional[bytes]:
+        """Shuttle bytes between the terminal and the PTY until the command's status arrives"""
+        status = b""
+        marker_seen = False
+        buffer = memoryview(self._buffer)
+        poller = select.poll()
+        for fd in (self._master, self._status, 0):
+            poller.register(fd, select.POLLIN)
+        while not (marker_seen and status.endswith(b"\0")):
+            done = status.endswith(b"\0")
+            try:
+                events = poller.poll(self.MARKER_GRACE * 1000 if done else None)
+            except InterruptedError:
+                continue
+            if not events:
+                # The command redirected the shell's stdout, so the marker went elsewhere
+                break
+            for fd, event in events:
+                if fd == self._master:
+                    try:
+                        size = os.readv(self._master, [buffer])
+                    except OSError:
+                        size = 0
+                    if not size:
+                        return status[:-1] if done else None
+                    if self._held:
+                        data = self._held + bytes(buffer[:size])
+                        marker_seen = self._scan(data, len(data)) or marker_seen
+                    else:
+                        marker_seen = self._scan(self._buffer, size) or marker_seen
+                elif fd == self._status:
+                    chunk = os.read(self._status, 4096)
+                    if not chunk:
+                        return None
+                    status += chunk
+                    if status.endswith(b"\0"):
+                        poller.unregister(self._status)
+                else:
+                    typed = os.read(0, 4096) if event & select.POLLIN else b""
+                    if typed:
+                        os.write(self._master, typed)
+                    else:
+                        poller.unregister(0)
+                        os.write(self._master, b"\x04")
+        return status[:-1]
 
-#something 
+    def _send(self, command: str) -> int:
+        sys.stdout.flush()
+        sys.stderr.flush()
+        self.capture = RingBuffer()
+        self._held = b""
+        try:
+            self._commands.write(command.encode() + b"\0")
+        except BrokenPipeError:
+            self.close()
+            self.start()
+            self._commands.write(command.encode() + b"\0")
 
+        saved = None
+        previous_winch = None
+        if os.isatty(0):
+            self._copy_window_size(self._master)
+            saved = termios.tcgetattr(0)
+            tty.setraw(0, termios.TCSANOW)
+            try:
+                previous_winch = signal.signal(signal.SIGWINCH, lambda *_: self._copy_window_size(self._master))
+            except ValueError:  # not the main thread
+                pass
+        try:
+            status = self._pump()
+        finally:
+            if saved is not None:
+                termios.tcsetattr(0, termios.TCSADRAIN, saved)
+            if previous_winch is not None:
+                signal.signal(signal.SIGWINCH, previous_winch)
 
-# Global state management
-command_history = []
-current_suggestion = ""
-suggestion_lock = threading.Lock()
-last_request_time = 0
+        if status is None:
+            # The command replaced or exited the shell (exec, exit); start afresh next time
+            code = self.process.wait()
+            self.close()
+            return code
+        sentinel, code, directories = status.decode(errors="replace").split(" ", 2)
+        if sentinel != self._sentinel:
+            return 1
+        cwd, _, oldpwd = directories.partition("\x1f")
+        # Keep this process in the shell's directory so project analysis and pwd see the same tree
+        try:
+            if cwd != os.getcwd():
+                os.chdir(cwd)
+        except OSError:
+            pass
+        os.environ["PWD"] = cwd
+        if oldpwd:
+            os.environ["OLDPWD"] = oldpwd
+        else:
+            os.environ.pop("OLDPWD", None)
+        return int(code)
 
-def get_ai_suggestion(user_input):
-    """Get command completion suggestions from the AI model."""
-    try:
-        if len(user_input.strip()) < 3:
-            return ""
 
-        # print(f"Requesting suggestion for: {user_input}")  # Debug print
-        completion = client.chat.completions.create(
-            model=FALLBACK_MODEL,
-            messages=[
-                {
-                    "role": "system", 
-                    "content": "You are a command-line expert. Complete the given command. Respond ONLY with the completed command, no explanations. Focus on common commands like git, docker, npm, pip, cat, touch, sudo, ls, cd, mkdir, rm, cp, mv, pwd, echo, grep, chmod, chown, ps, kill, top, man, whoami, ifconfig, ping, curl, wget, tar, unzip, zip, ssh, scp, find, history, clear, alias, df, du, nano, vi, apt, yum, dnf, pacman, service, systemctl, hostname, env, export, date, time, python, node, java, javac, gcc, make, htop, tmux, screen, netstat, traceroute, dig, npm, npx, pip3, virtualenv, conda, which, whereis, uname, lsb_release  etc . look out for other commands too",
-                },
-                {
-                    "role": "user", 
-                    "content": f"Complete this command: {user_input}"
-                }
-            ],
-            max_tokens=50,
-            temperature=0.1
-        )
-        
-        if not completion or not completion.choices:
-            return ""
-            
-        suggestion = completion.choices[0].message.content.strip()
-        suggestion = suggestion.split("\n")[0].split("#")[0].strip().strip('"').strip("'")
-        
-        # Ensure suggestion starts with user input
-        if suggestion and not suggestion.startswith(user_input):
-            suggestion = user_input + suggestion
-        elif suggestion == user_input:
-            suggestion += " "
-        
-        # print(f"Got suggestion: {suggestion}")  # Debug print
-        return suggestion
-        
-    except Exception as e:
-        print(f"[Error] AI suggestion failed: {str(e)}")
-        return ""
+shell_session = ShellSession()
 
-def get_shell_command(query):
-    """Convert natural language query to shell command"""
+# Characters that need the real shell: expansion, redirection, pipelines, lists
+SHELL_SYNTAX = re.compile(r"[;&|<>$`(){}*?\[\]\\!\n]")
+# history in command position, for commands like `history | grep ssh` that only the shell can run
+HISTORY_USE = re.compile(r"(?:^|[;&|(]\s*)history\b")
+aliases = {}
+builtin_counts = {}
+
+
+def _mirror(statement: str):
+    if shell_session.available():
+        shell_session.sync(statement)
+
+
+def builtin_cd(args: List[str]) -> int:
+    if len(args) > 1:
+        print("cd: too many arguments")
+        return 1
+    target = args[0] if args else os.environ.get("HOME", str(Path.home()))
+    if target == "-":
+        target = os.environ.get("OLDPWD", os.getcwd())
+        print(target)
     try:
-        # print(f"Sending query to AI: {query}")  # Debug print
-        completion = client.chat.completions.create(
-            model="openai/gpt-3.5-turbo:free",
-            messages=[
-                {
-                    "role": "system", 
-                    "content": """You are a command-line expert. Convert natural language queries into appropriate shell commands.
-                    For file operations, prefer simple commands like touch, echo, mkdir, etc.
-                    Respond ONLY with the command, no explanations or additional text."""
-                },
-                {
-                    "role": "user", 
-                    "content": f"Convert this to a shell command: {query}"
-                }
-            ],
-            max_tokens=50,
-            temperature=0.1
-        )
-        
-        if not completion or not completion.choices:
-            print(f"API Response: {completion}")  # Debug print
+        previous = os.getcwd()
+        os.chdir(os.path.expanduser(target))
+    except OSError as e:
+        print(f"cd: {target}: {e.strerror}")
+        return 1
+    os.environ["OLDPWD"] = previous
+    os.environ["PWD"] = os.getcwd()
+    _mirror(f"cd -- {shlex.quote(os.getcwd())}")
+    return 0
+
+
+def builtin_pwd(args: List[str]) -> int:
+    print(os.path.realpath(os.getcwd()) if "-P" in args else os.environ.get("PWD", os.getcwd()))
+    return 0
+
+
+def _list_environment() -> int:
+    for name, value in sorted(os.environ.items()):
+        print(f"declare -x {name}={shlex.quote(value)}")
+    return 0
+
+
+def builtin_export(args: List[str]) -> Optional[int]:
+    if not args or args == ["-p"]:
+        # Only the shell knows what sourced scripts (a venv's activate, say) exported
+        return None if shell_session.available() else _list_environment()
+    assignments = {}
+    for arg in args:
+        name, has_value, value = arg.partition("=")
+        if not re.fullmatch(r"[A-Za-z_][A-Za-z0-9_]*", name):
+            print(f"export: `{arg}': not a valid identifier")
+            return 1
+        if not has_value:
+            # Exporting an unexported shell variable is the shell's business
             return None
-            
-        command = completion.choices[0].message.content.strip()
-        command = command.split("\n")[0].split("#")[0].strip().strip('"').strip("'")
-        
-        print(f"Generated command: {command}")  # Debug print
-        return command
-        
-    except Exception as e:
-        print(f"Error in get_shell_command: {type(e).__name__}: {str(e)}")
+        assignments[name] = value
+    os.environ.update(assignments)
+    _mirror("export " + " ".join(f"{name}={shlex.quote(value)}" for name, value in assignments.items()))
+    return 0
+
+
+def builtin_alias(args: List[str]) -> Optional[int]:
+    if shell_session.available() and not (args and all("=" in arg for arg in args)):
+        # Listing and lookups go to the shell, which also has aliases its scripts defined
         return None
-def fetch_suggestion_async(text, session):
-    """Fetch suggestions asynchronously to avoid blocking the UI."""
-    global current_suggestion
-    
-    if len(text.strip()) < 2:
-        with suggestion_lock:
-            current_suggestion = ""
-        return
-        
-    suggestion = get_ai_suggestion(text)
-    
-    with suggestion_lock:
-        current_suggestion = suggestion
-    
-    # Force a refresh of the UI
-    if session.app:
-        session.app.invalidate()
+    if not args:
+        for name, value in sorted(aliases.items()):
+            print(f"alias {name}={shlex.quote(value)}")
+        return 0
+    status = 0
+    for arg in args:
+        name, has_value, value = arg.partition("=")
+        if has_value:
+            aliases[name] = value
+            _mirror(f"alias {name}={shlex.quote(value)}")
+        elif name in aliases:
+            print(f"alias {name}={shlex.quote(aliases[name])}")
+        else:
+            print(f"alias: {name}: not found")
+            status = 1
+    return status
 
-class AIAutoSuggest(AutoSuggest):
-    """Custom AutoSuggest class for AI-powered command completion."""
-    def get_suggestion(self, _buffer, document):
-        typed_text = document.text
-        if not typed_text.strip():
-            return None
-            
-        with suggestion_lock:
-            suggestion = current_suggestion
-            
-        if suggestion and suggestion.startswith(typed_text) and suggestion != typed_text:
-            return Suggestion(suggestion[len(typed_text):])
+
+def builtin_history(args: List[str]) -> int:
+    if args == ["-c"]:
+        clear_history()
+        return 0
+    try:
+        count = int(args[0]) if args else len(command_history)
+    except ValueError:
+        print(f"history: {args[0]}: numeric argument required")
+        return 1
+    start = max(0, len(command_history) - count)
+    for number, command in enumerate(command_history[start:], start + 1):
+        print(f"{number:5}  {command}")
+    return 0
+
+
+BUILTINS = {
+    "cd": builtin_cd,
+    "pwd": builtin_pwd,
+    "export": builtin_export,
+    "alias": builtin_alias,
+    "history": builtin_history,
+}
+
+# The last failed command with the tail of its output, offered to analyze_error
+last_failure = None
+# How much of the captured output goes into the analysis prompt
+ERROR_TAIL_LINES = 40
+ERROR_TAIL_CHARS = 4000
+TERMINAL_ESCAPE_PATTERN = re.compile(
+    r"\x1b\[[0-?]*[ -/]*[@-~]"          # CSI: colours, cursor movement
+    r"|\x1b\][^\x07\x1b]*(?:\x07|\x1b\\)"  # OSC: window titles, hyperlinks
+    r"|\x1b[@-Z\\-_]"                  # other two-byte escapes
+    r"|[\x00-\x08\x0b\x0c\x0e-\x1f\x7f]"   # remaining control characters
+)
+
+def plain_text(output: str) -> str:
+    """Terminal output as the user saw it: no escape sequences, only the last state of redrawn lines"""
+    lines = output.replace("\r\n", "\n").split("\n")
+    # A progress bar redraws its line after a carriage return; keep what was left on screen
+    return "\n".join(TERMINAL_ESCAPE_PATTERN.sub("", line.rsplit("\r", 1)[-1]) for line in lines)
+
+def failure_report(failure: Dict) -> str:
+    """Bounded, plain-text tail of a failed command's output, as analyze_error expects it"""
+    lines = [line for line in plain_text(failure['output']).rstrip().split("\n")][-ERROR_TAIL_LINES:]
+    tail = "\n".join(lines)[-ERROR_TAIL_CHARS:]
+    return f"{tail}\n(command: {failure['command']}, exit code {failure['exit_code']})"
+
+def with_history(command: str) -> str:
+    """command, with a history function for the shell when it pipes or redirects history.
+
+    The shell has never seen this process's history, so the listing goes
+    into a temporary file that the function prints and the command removes.
+    """
+    if not HISTORY_USE.search(command):
+        return command
+    fd, path = tempfile.mkstemp(prefix="aishell-history-")
+    with os.fdopen(fd, "w") as f:
+        f.writelines(f"{number:5}  {line}\n" for number, line in enumerate(command_history, 1))
+    path = shlex.quote(path)
+    return (f'history() {{ tail -n "${{1:-+1}}" -- {path}; }}\n'
+            f"{command}\n"
+            f"__aishell_history_status=$?\n"
+            f"unset -f history\n"
+            f"rm -f -- {path}\n"
+            f"(exit $__aishell_history_status)")
+
+def run_builtin(command: str) -> Optional[int]:
+    """Run a simple builtin in this process; None when the command needs a real shell"""
+    name = command.split(None, 1)[0]
+    if name not in BUILTINS or SHELL_SYNTAX.search(command):
+        return None
+    try:
+        args = shlex.split(command)[1:]
+    except ValueError:
         return None
+    code = BUILTINS[name](args)
+    if code is not None:
+        builtin_counts[name] = builtin_counts.get(name, 0) + 1
+    return code
 
 def execute_command(command: str) -> bool:
-    """Execute a shell command with proper shell activation handling"""
+    """Execute a shell command, in process for builtins and in the persistent shell session otherwise"""
     try:
-        # Special handling for virtual environment activation
-        if "venv" in command and ("activate" in command or "source" in command):
-            if platform.system().lower() == "windows":
-                # Windows activation
-                return subprocess.run(f"venv\\Scripts\\activate", shell=True, check=True).returncode == 0
-            else:
-                # Linux/Mac activation - use . instead of source
-                modified_command = command.replace("source", ".")
-                # Use bash explicitly for activation
-                return subprocess.run(modified_command, shell=True, executable='/bin/bash', check=True).returncode == 0
-        
-        # Regular command execution
-        return subprocess.run(command, shell=True, check=True).returncode == 0
-    except subprocess.CalledProcessError as e:
-        print(f"Command failed: {e}")
-        if e.stderr:
-            print(f"Error output: {e.stderr}")
-        return False
+        code = run_builtin(command)
+        if code is not None:
+            return code == 0
+        global last_failure
+        if shell_session.available():
+            code = shell_session.run(with_history(command))
+            output = shell_session.capture.tail()
+        else:
+            # No bash to keep a session in (Windows): one shell per command
+            code = subprocess.run(command, shell=True).returncode
+            output = ""
+        if code != 0:
+            print(f"Command failed with exit code {code}")
+            last_failure = {"command": command, "exit_code": code, "output": output}
+        return code == 0
     except Exception as e:
         print(f"Error executing command: {str(e)}")
         return False
+
+def run_command_benchmark(iterations: int = 200):
+    """Compare per-command latency of a fresh shell per command with the persistent session"""
+    def measure(run) -> List[float]:
+        samples = []
+        for _ in range(iterations):
+            started = time.perf_counter()
+            run("true")
+            samples.append(time.perf_counter() - started)
+        return sorted(samples)
+
+    fresh = measure(lambda command: subprocess.run(command, shell=True))
+    shell_session.run("true")  # start the coprocess outside the measurement
+    persistent = measure(shell_session.run)
+
+    print(f"\n=== Command benchmark ({iterations} runs of 'true') ===")
+    for name, samples in (("subprocess.run(shell=True)", fresh), ("persistent session", persistent)):
+        print(f"{name:28} mean {sum(samples) / len(samples) * 1000:7.2f} ms, "
+              f"p50 {samples[len(samples) // 2] * 1000:7.2f} ms, "
+              f"p99 {samples[int(len(samples) * 0.99)] * 1000:7.2f} ms")
+
+def run_pty_benchmark(megabytes: int = 300):
+    """Compare output throughput of the PTY session with a bare PTY and with no terminal at all.
+
+    Output goes to /dev/null for every case, so the numbers measure the
+    forwarding path rather than how fast this terminal can render.
+    """
+    command = f"head -c {megabytes}M /dev/zero"
+
+    def drain_bare_pty():
+        # What a terminal emulator does: read the PTY as fast as the child writes
+        master, slave = os.openpty()
+        child = subprocess.Popen(command, shell=True, stdout=slave)
+        os.close(slave)
+        try:
+            while os.read(master, ShellSession.READ_SIZE):
+                pass
+        except OSError:
+            pass
+        os.close(master)
+        child.wait()
+
+    sys.stdout.flush()
+    saved_stdout = os.dup(1)
+    devnull = os.open(os.devnull, os.O_WRONLY)
+    timings = {}
+    try:
+        os.dup2(devnull, 1)
+        shell_session.run("true")  # start the session outside the measurement
+        for name, run in (("no terminal (/dev/null)", lambda: subprocess.run(command, shell=True)),
+                          ("bare PTY", drain_bare_pty),
+                          ("PTY session with tee", lambda: shell_session.run(command))):
+            started = time.perf_counter()
+            run()
+            timings[name] = time.perf_counter() - started
+    finally:
+        os.dup2(saved_stdout, 1)
+        os.close(saved_stdout)
+        os.close(devnull)
+
+    print(f"\n=== PTY benchmark ({megabytes} MB of output) ===")
+    for name, elapsed in timings.items():
+        print(f"{name:26} {elapsed * 1000:8.0f} ms  {megabytes / elapsed:8.0f} MB/s")
+    capture = shell_session.capture
+    print(f"Tee kept the last {len(capture.getvalue()) // 1024} KiB of {capture.written // (1024 * 1024)} MB written")
+
+JOB_FLUSH_INTERVAL = 0.1  # seconds background output is batched before it is printed above the prompt
+JOB_OUTPUT_LINES = 1000  # lines of output kept per job for fg
+JOB_LINE_BYTES = 4096  # longest line kept; the end of longer ones (and of \r redraws) is shown
+
+
+class Job:
+    """A command started with a trailing ``&``, in its own process group"""
+
+    def __init__(self, job_id: int, command: str, process):
+        self.id = job_id
+        self.command = command
+        self.process = process
+        self.stopped = False
+        self.output = deque(maxlen=JOB_OUTPUT_LINES)
+        self.readers = []
+
+    @property
+    def done(self) -> bool:
+        return self.process.returncode is not None
+
+    def state(self) -> str:
+        if self.done:
+            return "Done" if self.process.returncode == 0 else f"Exit {self.process.returncode}"
+        return "Stopped" if self.stopped else "Running"
+
+    def signal(self, sig):
+        try:
+            os.killpg(self.process.pid, sig)
+        except ProcessLookupError:
+            pass
+
+
+class JobManager:
+    """Runs background jobs on the event loop and implements jobs, fg, bg and wait.
+
+    Background output is collected by reader tasks and printed in batches
+    through ``run_in_terminal``, which erases and redraws the prompt around
+    it, so typing and suggestions carry on while jobs run. A job brought
+    to the foreground prints straight to the terminal instead. While an
+    ordinary command has the terminal, jobs keep being drained but their
+    output is held until it returns.
+    """
+
+    COMMANDS = ("jobs", "fg", "bg", "wait")
+
+    def __init__(self):
+        self.jobs = {}
+        self.foreground = None
+        self._next_id = 1
+        self._pending = []
+        self._flush_handle = None
+        self._held = False
+        self._interrupted = None
+        self.started = 0
+        self.flushes = 0
+
+    @staticmethod
+    def available() -> bool:
+        return ShellSession.available()
+
+    @staticmethod
+    def is_background(command: str) -> bool:
+        stripped = command.rstrip()
+        return stripped.endswith("&") and not stripped.endswith("&&") and stripped[:-1].strip() != ""
+
+    def handles(self, command: str) -> bool:
+        return command.split(None, 1)[0] in self.COMMANDS
+
+    @staticmethod
+    def _trap(sig, handler) -> bool:
+        """Handle sig on the event loop; prompt_toolkit takes SIGINT back while a prompt is shown"""
+        try:
+            asyncio.get_running_loop().add_signal_handler(sig, handler)
+            return True
+        except (NotImplementedError, RuntimeError, AttributeError):
+            return False
+
+    @staticmethod
+    def _untrap(sig):
+        try:
+            asyncio.get_running_loop().remove_signal_handler(sig)
+        except (NotImplementedError, RuntimeError, AttributeError):
+            pass
+
+    def _on_sigint(self):
+        if self.foreground is not None:
+            self.foreground.signal(signal.SIGINT)
+        elif self._interrupted is not None:
+            self._interrupted.set()
+
+    def _on_sigtstp(self):
+        if self.foreground is not None:
+            self.foreground.signal(signal.SIGSTOP)
+            self.foreground.stopped = True
+
+    async def start(self, command: str) -> Job:
+        command = command.rstrip()[:-1].rstrip()
+        # Background jobs get their own bash, started with the session's directory, exported
+        # variables (venv PATH included) and aliases
+        prelude = "shopt -s expand_aliases\n"
+        handle, snapshot = tempfile.mkstemp(prefix="aishell-job-", suffix=".sh")
+        os.close(handle)
+        if shell_session.snapshot(snapshot):
+            prelude += f"source {shlex.quote(snapshot)}\nrm -f {shlex.quote(snapshot)}\n"
+        else:
+            os.unlink(snapshot)
+            prelude += "".join(f"alias {name}={shlex.quote(value)}\n" for name, value in aliases.items())
+        process = await asyncio.create_subprocess_exec(
+            "bash", "--noprofile", "--norc", "-c", prelude + command,
+            stdin=subprocess.DEVNULL, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE,
+            start_new_session=True,
+        )
+        job = Job(self._next_id, command, process)
+        self._next_id += 1
+        self.jobs[job.id] = job
+        self.started += 1
+        job.readers = [asyncio.ensure_future(self._read(job, stream))
+                       for stream in (process.stdout, process.stderr)]
+        asyncio.ensure_future(self._reap(job))
+        print(f"[{job.id}] {process.pid}")
+        return job
+
+    async def _read(self, job: Job, stream):
+        # Split lines here rather than with readline, which gives up on lines over its limit
+        partial = b""
+        while True:
+            chunk = await stream.read(ShellSession.READ_SIZE)
+            if not chunk:
+                if partial:
+                    self._line(job, partial)
+                return
+            *lines, partial = (partial + chunk).split(b"\n")
+            for line in lines:
+                self._line(job, line)
+            # A progress meter redraws after \r, so only what follows the last one is kept
+            partial = partial[partial.rfind(b"\r", 0, len(partial) - 1) + 1:][-JOB_LINE_BYTES:]
+
+    def _line(self, job: Job, line: bytes):
+        line = line.rstrip(b"\r")
+        text = line[line.rfind(b"\r") + 1:][-JOB_LINE_BYTES:].decode(errors="replace")
+        job.output.append(text)
+        self._emit(job, text)
+
+    async def _reap(self, job: Job):
+        await job.process.wait()
+        await asyncio.gather(*job.readers, return_exceptions=True)
+        if job is not self.foreground:
+            self._emit(job, None)
+
+    def _emit(self, job: Job, text: Optional[str]):
+        """Show a line of job output, or its completion notice when text is None"""
+        if job is self.foreground:
+            if text is not None:
+                print(text, flush=True)
+            return
+        self._pending.append(f"[{job.id}]+ {job.state():<10} {job.command}" if text is None
+                             else f"[{job.id}] {text}")
+        if self._flush_handle is None:
+            self._flush_handle = asyncio.get_running_loop().call_later(JOB_FLUSH_INTERVAL, self._flush)
+
+    def hold(self):
+        """Keep job output back while a foreground command owns the terminal"""
+        self._held = True
+
+    def release(self):
+        self._held = False
+        if self._pending and self._flush_handle is None:
+            self._flush()
+
+    def _flush(self):
+        self._flush_handle = None
+        if self._held:
+            # Only the newest lines are printed later; fg still has each job's own history
+            del self._pending[:-JOB_OUTPUT_LINES]
+            return
+        lines, self._pending = self._pending, []
+        if not lines:
+            return
+        self.flushes += 1
+        block = "\n".join(lines)
+        app = get_app_or_none()
+        if app is not None and app.is_running:
+            run_in_terminal(lambda: print(block, flush=True))
+        else:
+            print(block, flush=True)
+        for job_id in [job.id for job in self.jobs.values() if job.done and job is not self.foreground]:
+            del self.jobs[job_id]
+
+    def _select(self, args: List[str]) -> Optional[Job]:
+        if not self.jobs:
+            print("no current job")
+            return None
+        if not args:
+            return self.jobs[max(self.jobs)]
+        try:
+            return self.jobs[int(args[0].lstrip("%"))]
+        except (ValueError, KeyError):
+            print(f"{args[0]}: no such job")
+            return None
+
+    async def run(self, command: str) -> int:
+        """Run one of the job control builtins"""
+        name, *args = command.split()
+        if name == "jobs":
+            for job in self.jobs.values():
+                print(f"[{job.id}]  {job.state():<10} {job.command}")
+            return 0
+        if name == "bg":
+            job = self._select(args)
+            if job is None:
+                return 1
+            job.stopped = False
+            job.signal(signal.SIGCONT)
+            print(f"[{job.id}]+ {job.command} &")
+            return 0
+        if name == "fg":
+            job = self._select(args)
+            return 1 if job is None else await self._foreground(job)
+        return await self._wait([self._select(args)] if args else list(self.jobs.values()))
+
+    async def _foreground(self, job: Job) -> int:
+        print(job.command)
+        self._flush()
+        self.foreground = job
+        # Ctrl+C and Ctrl+Z go to the job, not to this shell
+        self._trap(signal.SIGINT, self._on_sigint)
+        self._trap(signal.SIGTSTP, self._on_sigtstp)
+        try:
+            if job.stopped:
+                job.stopped = False
+                job.signal(signal.SIGCONT)
+            waiter = asyncio.ensure_future(job.process.wait())
+            while not waiter.done():
+                await asyncio.wait({waiter}, timeout=0.1)
+                if job.stopped:
+                    waiter.cancel()
+                    print(f"\n[{job.id}]+ Stopped    {job.command}")
+                    return 148
+            await asyncio.gather(*job.readers, return_exceptions=True)
+            del self.jobs[job.id]
+            return job.process.returncode
+        finally:
+            self.foreground = None
+            self._untrap(signal.SIGINT)
+            self._untrap(signal.SIGTSTP)
+
+    async def _wait(self, jobs: List[Optional[Job]]) -> int:
+        jobs = [job for job in jobs if job is not None]
+        if not jobs:
+            return 1
+        self._interrupted = asyncio.Event()
+        interrupted = asyncio.ensure_future(self._interrupted.wait())
+        self._trap(signal.SIGINT, self._on_sigint)
+        try:
+            waiters = [asyncio.ensure_future(job.process.wait()) for job in jobs]
+            while not interrupted.done():
+                pending = [waiter for waiter in waiters if not waiter.done()]
+                if not pending:
+                    break
+                await asyncio.wait(pending + [interrupted], return_when=asyncio.FIRST_COMPLETED)
+            if interrupted.done():
+                return 130
+            return jobs[-1].process.returncode or 0
+        finally:
+            self._untrap(signal.SIGINT)
+            interrupted.cancel()
+            self._interrupted = None
+
+    def running(self) -> List[Job]:
+        return [job for job in self.jobs.values() if not job.done]
+
+    def shutdown(self):
+        for job in self.running():
+            job.signal(signal.SIGHUP)
+            if job.stopped:
+                job.signal(signal.SIGCONT)
+
+    def stats(self) -> Dict:
+        return {"started": self.started, "running": len(self.running()), "flushes": self.flushes}
+
+
+job_manager = JobManager()
+
+async def run_command(command: str) -> bool:
+    """Execute a command typed at the prompt, with background jobs and job control builtins"""
+    if job_manager.available():
+        if job_manager.is_background(command):
+            await job_manager.start(command)
+            return True
+        if job_manager.handles(command):
+            return await job_manager.run(command) == 0
+        # A worker thread runs the command so the event loop keeps draining background jobs
+        job_manager.hold()
+        resizes = JobManager._trap(signal.SIGWINCH, shell_session.resize)
+        try:
+            return await asyncio.get_running_loop().run_in_executor(None, execute_command, command)
+        finally:
+            if resizes:
+                JobManager._untrap(signal.SIGWINCH)
+            job_manager.release()
+    return execute_command(command)
+
+async def run_request(function, *args):
+    """Run a blocking AI step (translation, error analysis, setup planning) on a worker thread.
+
+    Its requests may wait for a scheduler slot that a suggestion task holds,
+    and only a running event loop lets that task release it. Ctrl+C
+    abandons the step like it used to interrupt it.
+    """
+    loop = asyncio.get_running_loop()
+    work = loop.run_in_executor(None, function, *args)
+    interrupted = loop.create_future()
+    trapped = JobManager._trap(signal.SIGINT, lambda: interrupted.done() or interrupted.set_result(None))
+    try:
+        await asyncio.wait({work, interrupted}, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        if trapped:
+            JobManager._untrap(signal.SIGINT)
+    if not work.done():
+        raise KeyboardInterrupt
+    return work.result()
+
 #added something her 
 class ProjectAnalyzer:
     """Analyzes project structure and dependencies across different project types"""
@@ -311,9 +3513,10 @@ class ProjectAnalyzer:
 def analyze_error(error_message: str) -> Dict:
     """Analyze error message using AI and project context"""
     # If it's a ModuleNotFoundError, handle it directly
-    if "ModuleNotFoundError: No module named" in error_message:
+    missing_module = re.search(r"ModuleNotFoundError: No module named '([^']+)'", error_message)
+    if missing_module:
         # Extract the module name from the error message
-        module_name = error_message.split("'")[1]
+        module_name = missing_module.group(1)
         return {
             "error_type": "import_error",
             "project_type": "python",
@@ -328,7 +3531,8 @@ def analyze_error(error_message: str) -> Dict:
     project_info = project_analyzer.scan_project()
     
     try:
-        completion = client.chat.completions.create(
+        completion = llm.create(
+            "analysis",
             model=FALLBACK_MODEL,
             messages=[
                 {
@@ -416,15 +3620,9 @@ def apply_fixes(analysis: Dict) -> bool:
         cmd_confirm = input("Execute this command? [y/N] ")
         
         if cmd_confirm.lower() == 'y':
-            try:
-                print(f"Executing: {cmd}")
-                result = subprocess.run(cmd, shell=True, check=True, capture_output=True, text=True)
-                if result.stdout:
-                    print(result.stdout)
-            except subprocess.CalledProcessError as e:
-                print(f"Command failed: {e}")
-                if e.stderr:
-                    print(f"Error output: {e.stderr}")
+            print(f"Executing: {cmd}")
+            # Runs in the PTY session: live progress output, and the active venv applies
+            if not execute_command(cmd):
                 success = False
                 
                 # Ask if user wants to continue after a failure
@@ -463,7 +3661,8 @@ def get_setup_commands(setup_request: str) -> List[Dict]:
     """Convert setup request into a sequence of commands and file operations"""
     try:
         # First, get AI to analyze the request
-        analysis = client.chat.completions.create(
+        analysis = llm.create(
+            "setup",
             model=FALLBACK_MODEL,
             messages=[
                 {
@@ -501,7 +3700,8 @@ def get_setup_commands(setup_request: str) -> List[Dict]:
         # For each file_create step, generate the content
         for step in steps:
             if step['operation'] == 'file_create':
-                content_completion = client.chat.completions.create(
+                content_completion = llm.create(
+                    "setup",
                     model=FALLBACK_MODEL,
                     messages=[
                         {
@@ -585,10 +3785,10 @@ def execute_setup_step(step: Dict) -> bool:
         print(f"Error executing step: {str(e)}")
         return False
 
-def handle_setup_request(request: str):
+async def handle_setup_request(request: str):
     """Handle a setup wizard request"""
     print(f"\nAnalyzing setup request: {request}")
-    steps = get_setup_commands(request)
+    steps = await run_request(get_setup_commands, request)
     
     if not steps:
         print("Could not generate setup steps. Please try rephrasing your request.")
@@ -615,18 +3815,125 @@ def handle_setup_request(request: str):
                 
     print("\nSetup completed!")
 
-def main():
+def print_stats():
+    """Print runtime counters for the suggestion pipeline"""
+    print("\n=== AI Shell stats ===")
+    print(f"API: {api_state.describe()}")
+    cache = suggestion_cache.stats()
+    print(f"Suggestion cache: {cache['entries']} entries, {cache['hits']} hits, "
+          f"{cache['misses']} misses ({cache['hit_rate']:.0%} hit rate)")
+    disk = disk_cache.stats()
+    print(f"Disk cache: {disk['rows']} rows, {disk['hits']} hits, {disk['misses']} misses, "
+          f"{disk['busy']} busy" + (" (disabled)" if disk['disabled'] else ""))
+    client_stats = llm.stats()
+    print(f"Client: {client_stats['sent']} sent, {client_stats['dropped']} dropped, "
+          f"{client_stats['retries']} retries, {client_stats['failures']} failures, "
+          f"circuit {client_stats['circuit']} ({client_stats['trips']} trips)")
+    if client_stats['last_error']:
+        print(f"  last error: {client_stats['last_error']}")
+    print("Scheduler:")
+    for cls, info in scheduler.stats().items():
+        print(f"  {cls}: {info['active']}/{info['limit']} active, {info['queued']} queued "
+              f"(max {info['max_depth']}), {info['granted']} granted, "
+              f"avg wait {info['avg_wait'] * 1000:.0f} ms")
+    pool = connection_stats.stats()
+    versions = ", ".join(f"{v}: {n}" for v, n in pool['http_versions'].items()) or "none"
+    print(f"Connections: {pool['requests']} requests over {pool['connections']} connections, "
+          f"{pool['reused']} reused ({pool['reuse_rate']:.0%}); {versions}")
+    hedging = hedger.stats()
+    print(f"Hedging: {hedging['requests']} requests, {hedging['hedges']} hedged")
+    for model, info in hedging['models'].items():
+        print(f"  {model}: {info['wins']} wins, {info['samples']} samples, "
+              f"p50 {info['p50'] * 1000:.0f} ms, hedge after {info['hedge_delay'] * 1000:.0f} ms")
+    templates = token_meter.stats()
+    if templates:
+        print("Suggestion prompts (per call):")
+        for template, info in templates.items():
+            print(f"  {template}: {info['calls']} calls, {info['prompt_tokens']:.0f} prompt + "
+                  f"{info['completion_tokens']:.0f} completion tokens, first token "
+                  f"{info['first_token'] * 1000:.0f} ms, total {info['latency'] * 1000:.0f} ms"
+                  + (f" ({info['estimated']} estimated)" if info['estimated'] else ""))
+    speculation = prefetcher.stats()
+    print(f"Prefetch: {speculation['requests']} requests, {speculation['hits']} hits "
+          f"({speculation['hit_rate']:.0%} of requests), {speculation['skipped']} skipped, "
+          f"{speculation['cancelled']} cancelled")
+    executables = path_index.stats()
+    print(f"PATH index: {executables['executables']} executables, {executables['builds']} builds, "
+          f"{executables['hits']} hits, {executables['misses']} misses")
+    listings = directory_cache.stats()
+    print(f"Path cache: {listings['directories']} directories, {listings['names']} names, "
+          f"{listings['hit_rate']:.0%} hit rate ({listings['hits']} hits, {listings['misses']} misses)")
+    options = flag_index.stats()
+    print(f"Flag index: {options['commands']} commands ({options['parsed']} parsed, {options['loaded']} from disk, "
+          f"{options['failed']} without flags), {options['hit_rate']:.0%} hit rate")
+    history = command_trie.stats()
+    print(f"History trie: {history['commands']} commands, {history['hits']} hits, "
+          f"{history['misses']} misses")
+    builtins = ", ".join(f"{name} {count}" for name, count in sorted(builtin_counts.items())) or "none"
+    print(f"Shell: {shell_session.commands} commands in {shell_session.started} session(s), "
+          f"{shell_session.captured_bytes} bytes of output captured ({CAPTURE_BYTES // 1024} KiB kept per command); "
+          f"in-process builtins: {builtins}")
+    jobs = job_manager.stats()
+    print(f"Jobs: {jobs['started']} started, {jobs['running']} running, "
+          f"background output printed in {jobs['flushes']} batches")
+    redraws = redraw_limiter.stats()
+    print(f"Redraws: {redraws['frames']} frames for {redraws['invalidations']} invalidations "
+          f"(cap {redraws['max_fps'] or 'none'} fps); {redraws['requests']} suggestion redraws requested, "
+          f"{redraws['coalesced']} coalesced")
+    if shell_completer:
+        print("Completion sources:")
+        for source, info in shell_completer.stats().items():
+            print(f"  {source}: {info['served']} served, {info['late']} over budget, "
+                  f"mean {info['mean_latency'] * 1000:.1f} ms (budget {COMPLETION_BUDGETS[source] * 1000:.0f} ms)")
+    if ai_suggest:
+        suggest = ai_suggest.stats()
+        print(f"Suggestions: {suggest['fetched']} fetched, {suggest['cancelled']} cancelled in flight")
+        debounce = ai_suggest.debouncer.stats()
+        print(f"Debounce: {debounce['keystrokes']} keystrokes, {debounce['fetches']} fetches, "
+              f"{debounce['suppressed']} suppressed, delay {debounce['delay'] * 1000:.0f} ms "
+              f"(typing {debounce['typing_interval'] * 1000:.0f} ms, "
+              f"model {debounce['model_latency'] * 1000:.0f} ms)")
+
+async def run_startup_benchmark(session, message):
+    """Render the first prompt, exit immediately and report startup timings"""
+    main_start = time.perf_counter()
+    timings = {}
+
+    def exit_after_first_render():
+        timings['first_prompt'] = time.perf_counter()
+        session.app.exit(result="")
+
+    def pre_run():
+        # Scheduled behind the initial redraw, so this fires once the prompt is on screen
+        asyncio.get_running_loop().call_soon(exit_after_first_render)
+
+    await session.prompt_async(message, pre_run=pre_run)
+
+    print("\n=== Startup benchmark ===")
+    print(f"Import time:       {(main_start - _STARTUP_T0) * 1000:8.1f} ms")
+    print(f"First prompt:      {(timings['first_prompt'] - _STARTUP_T0) * 1000:8.1f} ms")
+    print(f"API probe:         {api_state.describe()}")
+
+def main(startup_benchmark: bool = False):
+    # One event loop for the whole session, so the async connection pool survives between prompts
+    asyncio.run(main_async(startup_benchmark))
+
+async def main_async(startup_benchmark: bool = False):
     style = Style.from_dict({
         'prompt': '#00aa00 bold',  # Green prompt
         'suggestion': '#666666 italic',  # Gray suggestions
     })
     
+    auto_suggest = AIAutoSuggest()
+    completer = ShellCompleter(auto_suggest)
     session = PromptSession(
-        auto_suggest=AIAutoSuggest(),
+        auto_suggest=auto_suggest,
+        completer=completer,
         style=style,
         complete_while_typing=True,
-        complete_in_thread=True
     )
+    # y/N answers get a bare prompt: no completion menu, no suggestions, no shared history
+    confirm_session = PromptSession(style=style)
     
     bindings = KeyBindings()
 
@@ -634,9 +3941,23 @@ def main():
     @bindings.add("right")
     def _(event):
         buff = event.app.current_buffer
-        if buff.suggestion:
+        if buff.complete_state and event.key_sequence[-1].key == "tab":
+            buff.complete_next()
+        elif buff.suggestion:
             buff.insert_text(buff.suggestion.text)
 
+    @bindings.add("escape", "n")
+    @bindings.add("escape", "p")
+    async def _(event):
+        """Cycle through alternative suggestions without a new request"""
+        auto_suggest.cycle(1 if event.key_sequence[-1].key == "n" else -1)
+        buff = event.app.current_buffer
+        document = buff.document
+        suggestion = await asyncio.get_running_loop().run_in_executor(
+            None, auto_suggest.get_suggestion, buff, document)
+        if buff.document == document:
+            buff.suggestion = suggestion
+
     @bindings.add("c-c")
     def _(event):
         event.app.exit(result=None)
@@ -647,39 +3968,39 @@ def main():
         """Handle setup wizard requests"""
         event.app.current_buffer.text = "/"
 
-    # Debounce suggestion requests
-    last_fetch_time = 0
-    min_delay_between_fetches = 0.3  # 300ms minimum delay between fetches
-    
-    def on_text_changed(_):
-        nonlocal last_fetch_time
-        current_time = time.time()
-        
-        if current_time - last_fetch_time < min_delay_between_fetches:
-            return
-            
-        last_fetch_time = current_time
-        buffer_text = session.default_buffer.document.text
-        
-        if buffer_text.startswith("?") or len(buffer_text.strip()) < 2:
-            return
-            
-        threading.Thread(
-            target=fetch_suggestion_async,
-            args=(buffer_text, session),
-            daemon=True
-        ).start()
+    session.default_buffer.on_text_changed += auto_suggest.on_text_changed
+    redraw_limiter.attach(session.app)
+    warned_jobs = False
 
-    session.default_buffer.on_text_changed += on_text_changed
+    global ai_suggest, shell_completer
+    ai_suggest = auto_suggest
+    shell_completer = completer
+    def load_history_and_index():
+        load_history()
+        flag_index.index_frequent(command_history)
+
+    threading.Thread(target=load_history_and_index, daemon=True).start()
+    threading.Thread(target=warm_suggestion_cache, daemon=True).start()
+    threading.Thread(target=path_index.build, daemon=True).start()
+    asyncio.ensure_future(warm_async_connection())
+
+    if startup_benchmark:
+        await run_startup_benchmark(session, HTML('<prompt>$ </prompt>'))
+        return
 
     print("=== AI Shell ===")
     print("Type commands directly or start with ? for natural language (e.g., ?how to list all files)")
     print("Press TAB or RIGHT ARROW to complete suggestions, ENTER to execute")
+    print("Press TAB while the completion menu is open to move through it")
+    print("Press ALT+N / ALT+P to cycle through alternative suggestions")
+    print("End a command with & to run it in the background; manage it with jobs, fg, bg and wait")
+    print("After a failed command, !error with no message analyzes its captured error output")
+    print("Type !stats to show suggestion cache and connection stats")
     
     while True:
         try:
             message = HTML('<prompt>$ </prompt>')
-            user_input = session.prompt(message, key_bindings=bindings)
+            user_input = await session.prompt_async(message, key_bindings=bindings)
             
             if user_input is None:
                 continue
@@ -689,26 +4010,39 @@ def main():
                 continue
                 
             if user_input.lower() in ("exit", "quit"):
+                if job_manager.running() and not warned_jobs:
+                    warned_jobs = True
+                    print("There are running jobs; exit again to stop them and quit.")
+                    continue
+                job_manager.shutdown()
                 break
 
+            if user_input == "!stats":
+                print_stats()
+                continue
+
             # Handle setup wizard requests
             if user_input.startswith("/"):
                 request = user_input[1:].strip()
                 if not request:
                     print("Please provide a setup request after /")
                     continue
-                handle_setup_request(request)
+                await handle_setup_request(request)
                 continue
             
             # Handle error analysis
             if user_input.startswith("!error"):
                 error_msg = user_input[6:].strip()
+                if not error_msg and last_failure and last_failure["output"].strip():
+                    # No argument: analyze what the last failed command printed
+                    error_msg = failure_report(last_failure)
                 if not error_msg:
                     print("Usage: !error <paste error message>")
                     continue
                     
                 print("\nAnalyzing error...")
-                analysis = analyze_error(error_msg)
+                warn_if_api_unavailable()
+                analysis = await run_request(analyze_error, error_msg)
                 if analysis:
                     apply_fixes(analysis)
                 continue
@@ -720,14 +4054,15 @@ def main():
                     continue
                     
                 print("Translating query...")
+                warn_if_api_unavailable()
                 try:
-                    command = get_shell_command(query)
+                    command = await run_request(get_shell_command, query)
                     if not command:
                         print("Could not generate a command for your query. Please try rephrasing it.")
                         continue
                         
                     # print(f"Suggested command: {command}")
-                    confirm = session.prompt("Execute this command? [y/N] ")
+                    confirm = await confirm_session.prompt_async("Execute this command? [y/N] ")
                     if confirm.lower() != 'y':
                         continue
                     user_input = command
@@ -735,11 +4070,21 @@ def main():
                     print(f"Error processing query: {str(e)}")
                     continue
 
-            command_history.append(user_input)
-            with suggestion_lock:
-                current_suggestion = ""
+            record_command(user_input)
+            auto_suggest.cancel_inflight()
             
-            execute_command(user_input)
+            previous_failure = last_failure
+            if await run_command(user_input) or last_failure is previous_failure:
+                continue
+            if not last_failure["output"].strip():
+                continue
+            confirm = await confirm_session.prompt_async("Analyze the error output? [y/N] ")
+            if confirm.lower() == 'y':
+                print("\nAnalyzing error...")
+                warn_if_api_unavailable()
+                analysis = await run_request(analyze_error, failure_report(last_failure))
+                if analysis:
+                    apply_fixes(analysis)
             
         except KeyboardInterrupt:
             print("\nUse 'exit' or 'quit' to exit")
@@ -748,4 +4093,25 @@ def main():
             print(f"\nError: {e}")
 
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser(description="AI-powered interactive shell")
+    parser.add_argument("--startup-benchmark", action="store_true",
+                        help="report import and first-prompt times, then exit")
+    parser.add_argument("--no-stream", action="store_true",
+                        help="show suggestions only once the full completion has arrived")
+    parser.add_argument("--command-benchmark", action="store_true",
+                        help="compare per-command latency of a fresh shell with the persistent session, then exit")
+    parser.add_argument("--pty-benchmark", action="store_true",
+                        help="measure output throughput through the PTY session, then exit")
+    parser.add_argument("--max-fps", type=int, default=MAX_FRAME_RATE,
+                        help="maximum prompt redraws per second (0 for no cap)")
+    args = parser.parse_args()
+    MAX_FRAME_RATE = max(0, args.max_fps)
+    if args.no_stream:
+        STREAM_SUGGESTIONS = False
+    if args.command_benchmark:
+        run_command_benchmark()
+        sys.exit(0)
+    if args.pty_benchmark:
+        run_pty_benchmark()
+        sys.exit(0)
+    main(startup_benchmark=args.startup_benchmark)
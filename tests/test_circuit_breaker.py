@@ -0,0 +1,76 @@
+import asyncio
+import os
+import threading
+import time
+from types import SimpleNamespace
+
+import httpx
+import pytest
+
+os.environ.setdefault("deepseek_api", "test-key")
+
+import shell  # noqa: E402
+
+
+def _client(create):
+    return SimpleNamespace(chat=SimpleNamespace(completions=SimpleNamespace(create=create)))
+
+
+def _half_open_client(create):
+    llm = shell.ResilientClient(_client(None), _client(create))
+    llm.breaker.state = shell.CircuitBreaker.OPEN
+    llm.breaker.opened_until = 0.0
+    return llm
+
+
+def test_cancelled_half_open_trial_does_not_wedge_the_breaker(monkeypatch):
+    monkeypatch.setattr(shell.CircuitBreaker, "RETRIAL_COOLDOWN", 0.0)
+
+    async def cancelled(**kwargs):
+        raise asyncio.CancelledError()
+
+    llm = _half_open_client(cancelled)
+    with pytest.raises(asyncio.CancelledError):
+        asyncio.run(llm.acreate("suggestion", model="m", messages=[]))
+
+    assert llm.breaker.state == shell.CircuitBreaker.OPEN
+    assert llm.breaker.allow()
+
+
+def test_dropped_half_open_trial_does_not_wedge_the_breaker(monkeypatch):
+    monkeypatch.setattr(shell.CircuitBreaker, "RETRIAL_COOLDOWN", 0.0)
+    llm = _half_open_client(None)
+    llm.bucket.tokens = 0
+    llm.bucket.rate = 1e-9
+
+    with pytest.raises(shell.LLMUnavailableError):
+        llm.create("suggestion", model="m", messages=[])
+
+    assert llm.breaker.allow()
+
+
+def test_unresolved_trial_expires(monkeypatch):
+    breaker = shell.CircuitBreaker()
+    breaker.state = breaker.OPEN
+    assert breaker.allow()
+    assert not breaker.allow()
+    breaker.trial_deadline = 0.0
+    assert breaker.allow()
+
+
+def test_cancelled_foreground_call_stops_retrying():
+    cancelled = threading.Event()
+    calls = []
+
+    def failing(**kwargs):
+        calls.append(kwargs)
+        cancelled.set()
+        raise shell.APIConnectionError(request=httpx.Request("POST", "https://example.invalid"))
+
+    llm = shell.ResilientClient(_client(failing), _client(None))
+    started = time.monotonic()
+    with pytest.raises(shell.LLMUnavailableError):
+        llm.create("translate", cancelled=cancelled, model="m", messages=[])
+
+    assert len(calls) == 1
+    assert time.monotonic() - started < shell.ResilientClient.BACKOFF_BASE
@@ -0,0 +1,37 @@
+import os
+import sqlite3
+
+os.environ.setdefault("deepseek_api", "test-key")
+
+import shell  # noqa: E402
+
+
+class _FailingConnection:
+    def __init__(self, error):
+        self.error = error
+
+    def execute(self, sql, params=()):
+        raise self.error
+
+
+def test_locked_database_is_a_miss_not_a_shutdown(tmp_path):
+    cache = shell.DiskCache(tmp_path / "cache.sqlite3")
+    cache.put("suggest", "git st", "git status")
+    real = cache._conn
+    cache._conn = _FailingConnection(sqlite3.OperationalError("database is locked"))
+    for _ in range(cache.MAX_ERRORS + 2):
+        assert cache.get("suggest", "git st") is None
+    assert not cache.disabled
+    assert cache.busy == cache.MAX_ERRORS + 2
+    cache._conn = real
+    assert cache.get("suggest", "git st") == "git status"
+
+
+def test_persistent_errors_disable_the_cache(tmp_path):
+    cache = shell.DiskCache(tmp_path / "cache.sqlite3")
+    cache._conn = _FailingConnection(sqlite3.DatabaseError("file is not a database"))
+    for _ in range(cache.MAX_ERRORS - 1):
+        cache.get("suggest", "ls")
+    assert not cache.disabled
+    cache.get("suggest", "ls")
+    assert cache.disabled
@@ -0,0 +1,37 @@
+import os
+import shutil
+
+import pytest
+
+os.environ.setdefault("deepseek_api", "test-key")
+
+import shell  # noqa: E402
+
+
+@pytest.fixture
+def git_foo(tmp_path, monkeypatch):
+    """A git-foo program on PATH that leaves a file behind when it runs"""
+    if not shutil.which("git"):
+        pytest.skip("needs git")
+    ran = tmp_path / "ran"
+    script = tmp_path / "bin" / "git-foo"
+    script.parent.mkdir()
+    script.write_text(f"#!/bin/sh\ntouch {ran}\necho '  -a  all'; echo '  -b  both'; echo '  -c  count'\n")
+    script.chmod(0o755)
+    monkeypatch.setenv("PATH", f"{script.parent}{os.pathsep}{os.environ['PATH']}")
+    monkeypatch.setattr(shell, "disk_cache", shell.DiskCache(tmp_path / "cache.sqlite3"))
+    return ran
+
+
+def test_unknown_subcommand_is_never_executed(git_foo):
+    flags = shell.FlagIndex()
+    flags.index("git foo")
+    flags.index_frequent(["git foo -a"] * 5)
+    assert flags._queue.empty()
+    assert not git_foo.exists()
+
+
+def test_builtin_subcommand_uses_its_help():
+    assert shell.help_argument("git log") == "-h"
+    assert shell.help_argument("git foo") is None
+    assert shell.help_argument("myscript") is None
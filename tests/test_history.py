@@ -0,0 +1,19 @@
+import os
+
+os.environ.setdefault("deepseek_api", "test-key")
+
+import shell  # noqa: E402
+
+
+def test_history_file_is_trimmed_on_load(tmp_path, monkeypatch):
+    history = tmp_path / ".aishell_history"
+    history.write_text("".join(f"{1000 + i}\techo {i}\n" for i in range(30)))
+    monkeypatch.setattr(shell, "HISTORY_FILE", history)
+    monkeypatch.setattr(shell, "HISTORY_LIMIT", 10)
+    monkeypatch.setattr(shell, "command_history", [])
+    monkeypatch.setattr(shell, "command_trie", shell.HistoryTrie())
+
+    shell.load_history()
+
+    assert shell.command_history == [f"echo {i}" for i in range(20, 30)]
+    assert history.read_text().splitlines() == [f"{1000 + i}\techo {i}" for i in range(20, 30)]
@@ -0,0 +1,54 @@
+import asyncio
+import os
+
+import pytest
+
+os.environ.setdefault("deepseek_api", "test-key")
+
+import shell  # noqa: E402
+
+pytestmark = pytest.mark.skipif(not shell.JobManager.available(), reason="needs bash and a PTY")
+
+
+async def _finish(job, timeout=5.0):
+    await asyncio.wait_for(job.process.wait(), timeout)
+    await asyncio.wait_for(asyncio.gather(*job.readers), timeout)
+
+
+def test_job_output_without_newlines_is_drained():
+    async def main():
+        manager = shell.JobManager()
+        job = await manager.start(r"head -c 300000 /dev/zero | tr '\0' a; echo finished &")
+        await _finish(job)
+        return job
+
+    job = asyncio.run(main())
+    # The over-long line is kept by its end, which is where "finished" was appended
+    assert list(job.output) == ["a" * (shell.JOB_LINE_BYTES - len("finished")) + "finished"]
+    assert job.process.returncode == 0
+
+
+def test_progress_redraws_keep_the_last_state():
+    async def main():
+        manager = shell.JobManager()
+        job = await manager.start(r"printf '10%%\r50%%\r100%%\r\ndone\n' &")
+        await _finish(job)
+        return job
+
+    assert list(asyncio.run(main()).output) == ["100%", "done"]
+
+
+def test_jobs_keep_running_during_a_foreground_command():
+    async def main():
+        job = await shell.job_manager.start("seq 1 300000 >/dev/null; echo counted &")
+        try:
+            await shell.run_command("sleep 2")
+            return job.done, list(job.output)
+        finally:
+            shell.shell_session.close()
+
+    cwd = os.getcwd()
+    try:
+        assert asyncio.run(main()) == (True, ["counted"])
+    finally:
+        os.chdir(cwd)
@@ -0,0 +1,20 @@
+import os
+import subprocess
+
+os.environ.setdefault("deepseek_api", "test-key")
+
+import shell  # noqa: E402
+
+
+def test_completed_names_are_escaped_for_the_shell(tmp_path, monkeypatch):
+    for name in ("my notes.txt", "a&b.txt"):
+        (tmp_path / name).write_text(name)
+    monkeypatch.chdir(tmp_path)
+
+    assert shell.structural_candidates("cat my") == ("path", [r"cat my\ notes.txt"])
+    assert shell.structural_candidates("cat a") == ("path", [r"cat a\&b.txt"])
+    # An escaped partial name is looked up unescaped and kept as typed
+    assert shell.structural_candidates(r"cat my\ no") == ("path", [r"cat my\ notes.txt"])
+
+    for line, name in ((r"cat my\ notes.txt", "my notes.txt"), (r"cat a\&b.txt", "a&b.txt")):
+        assert subprocess.run(["sh", "-c", line], capture_output=True, text=True).stdout == name
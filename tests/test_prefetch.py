@@ -0,0 +1,37 @@
+import asyncio
+import os
+
+os.environ.setdefault("deepseek_api", "test-key")
+
+import shell  # noqa: E402
+
+
+def test_prefetch_makes_exactly_one_request(monkeypatch, tmp_path):
+    asked = []
+
+    async def slow_stream(user_input, model, on_partial=None, call_type="suggestion"):
+        asked.append(model)
+        await asyncio.sleep(0.3)
+        return [user_input + "it"]
+
+    monkeypatch.setattr(shell, "_stream_suggestion", slow_stream)
+    monkeypatch.setattr(shell, "disk_cache", shell.DiskCache(tmp_path / "cache.sqlite3"))
+    monkeypatch.setattr(shell.RequestHedger, "DEFAULT_DELAY", 0.05)
+    monkeypatch.setattr(shell, "suggestion_cache", shell.SuggestionCache())
+
+    monkeypatch.setattr(shell.api_state, "usable", lambda: True)
+
+    assert asyncio.run(shell.get_ai_suggestion("git comm", call_type="prefetch")) == "git commit"
+    assert asked == [shell.hedger.models[0]]
+
+
+def test_one_prefetch_counts_one_hit():
+    cache = shell.SuggestionCache()
+    cache.put("docker run ", ["docker run -it ubuntu"], speculative="docker run ")
+    cache.put("docker ru", ["docker run -it ubuntu"], speculative="docker run ")
+    cache.put("docker r", ["docker run -it ubuntu"], speculative="docker run ")
+
+    cache.candidates("docker r")
+    cache.candidates("docker ru")
+    cache.candidates("docker run -")
+    assert cache.speculative_hits == 1
@@ -0,0 +1,37 @@
+import asyncio
+import os
+
+import pytest
+
+os.environ.setdefault("deepseek_api", "test-key")
+
+import shell  # noqa: E402
+
+
+def test_sync_acquire_gives_up_after_its_timeout():
+    scheduler = shell.RequestScheduler(total=1, limits={"interactive": 1, "foreground": 1, "background": 1})
+    release = scheduler.acquire("setup")
+    with pytest.raises(shell.LLMUnavailableError):
+        scheduler.acquire("setup", timeout=0.1)
+    release()
+    scheduler.acquire("setup", timeout=0.1)()
+    assert scheduler.stats()["background"]["queued"] == 0
+
+
+def test_blocking_request_waits_for_a_slot_held_on_the_event_loop(monkeypatch):
+    scheduler = shell.RequestScheduler(total=1, limits={"interactive": 1, "foreground": 1, "background": 1})
+    monkeypatch.setattr(shell, "scheduler", scheduler)
+
+    async def prefetch():
+        release = await scheduler.acquire_async("prefetch")
+        await asyncio.sleep(0.2)  # e.g. a cancelled stream still closing
+        release()
+
+    async def main():
+        holder = asyncio.ensure_future(prefetch())
+        await asyncio.sleep(0)
+        release = await shell.run_request(lambda: scheduler.acquire("setup", timeout=5.0))
+        release()
+        await holder
+
+    asyncio.run(asyncio.wait_for(main(), 5.0))
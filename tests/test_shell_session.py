@@ -0,0 +1,85 @@
+import os
+import threading
+import time
+
+import pytest
+
+os.environ.setdefault("deepseek_api", "test-key")
+
+import shell  # noqa: E402
+
+pytestmark = pytest.mark.skipif(not shell.ShellSession.available(), reason="needs bash and a PTY")
+
+
+@pytest.fixture
+def session():
+    cwd = os.getcwd()
+    session = shell.ShellSession()
+    yield session
+    session.close()
+    os.chdir(cwd)
+
+
+@pytest.fixture
+def typed():
+    """Replace stdin with a pipe; returns its write end"""
+    read_end, write_end = os.pipe()
+    saved = os.dup(0)
+    os.dup2(read_end, 0)
+    os.close(read_end)
+    yield write_end
+    os.dup2(saved, 0)
+    os.close(saved)
+    os.close(write_end)
+
+
+def _type_later(fd, data, delay):
+    threading.Timer(delay, os.write, (fd, data)).start()
+
+
+def test_ctrl_c_aborts_a_shell_loop(session, typed):
+    session.run("true")
+    # Without the fix the loop never ends; kill the shell so the test fails instead of hanging
+    watchdog = threading.Timer(10, session.process.kill)
+    watchdog.start()
+    _type_later(typed, b"\x03", 0.5)
+    started = time.monotonic()
+    code = session.run("while true; do sleep 0.2; done; echo after")
+    assert code == 130
+    assert time.monotonic() - started < 5
+    assert "after" not in session.capture.tail()
+
+    # The trap is armed again for the next command, and the shell kept its state
+    session.run("cd /tmp; __aishell_test=kept")
+    _type_later(typed, b"\x03", 0.5)
+    assert session.run("for i in 1 2 3 4 5 6 7 8 9 10; do sleep 1; done") == 130
+    assert session.run('test "$__aishell_test" = kept && test "$PWD" = /tmp') == 0
+    watchdog.cancel()
+
+
+def test_pwd_and_oldpwd_follow_the_shell(session, monkeypatch):
+    monkeypatch.setenv("PWD", "/root")
+    start = os.getcwd()
+    session.run("cd /tmp && true")
+    assert os.environ["PWD"] == "/tmp"
+    assert os.environ["OLDPWD"] == start
+
+
+@pytest.fixture
+def global_session(monkeypatch):
+    cwd = os.getcwd()
+    monkeypatch.setattr(shell, "shell_session", shell.ShellSession())
+    yield shell.shell_session
+    shell.shell_session.close()
+    os.chdir(cwd)
+
+
+def test_listing_exports_and_aliases_shows_what_the_shell_defined(global_session):
+    assert shell.execute_command("export AISHELL_SOURCED=1; alias aishell_ll='ls -l'")
+    assert "AISHELL_SOURCED" not in os.environ
+
+    assert shell.execute_command("export")
+    assert "AISHELL_SOURCED" in global_session.capture.tail()
+    assert shell.execute_command("alias")
+    assert "aishell_ll" in global_session.capture.tail()
+    assert shell.execute_command("alias aishell_ll")